@@ -0,0 +1,37 @@
+"""COVID hospitalizations and deaths compared with reported vaccine adverse effects,
+by age class, from the covid-19-schweiz dataset on opendata.swiss.
+
+Submodules are only imported when one of their names is first used, so that
+importing the package does not load pandas, matplotlib or ckanapi.
+"""
+
+import importlib
+from typing import Any
+
+_EXPORTS = {
+    "CovidData": "counts",
+    "get_all_data": "counts",
+    "get_bulk_counts": "counts",
+    "get_counts": "counts",
+    "get_labels": "counts",
+    "get_region_counts": "counts",
+    "index_region_counts": "counts",
+    "index_window_counts": "counts",
+    "rebin_counts": "counts",
+    "region_counts": "counts",
+    "get_window_counts": "counts",
+    "ChartRenderer": "chart",
+    "build_graph": "chart",
+    "cached_render": "chart",
+    "render_charts": "chart",
+    "get_resource_map": "ckan",
+    "add_rates": "population",
+    "load_population": "population",
+}
+
+
+def __getattr__(name: str) -> Any:
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f".{module}", __name__), name)
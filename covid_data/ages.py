@@ -0,0 +1,150 @@
+"""Age class schemes, and rebinning of counts from one scheme to another."""
+
+import re
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Age classes are intervals of whole years below AGE_LIMIT, open classes like "80+"
+# ending at AGE_LIMIT. Classes of unknown age are kept apart from the intervals.
+AGE_LIMIT = 90
+UNKNOWN_AGES = ("Unbekannt", "unknown")
+# Age classes of the weekly death and hospitalization resources
+BAG_AGE_CLASSES = (
+    "0 - 9",
+    "10 - 19",
+    "20 - 29",
+    "30 - 39",
+    "40 - 49",
+    "50 - 59",
+    "60 - 69",
+    "70 - 79",
+    "80+",
+    "Unbekannt",
+)
+# Age classes of the vaccine adverse effects resource
+SYMPTOM_AGE_CLASSES = (
+    "0 - 1",
+    "2 - 11",
+    "12 - 17",
+    "18 - 44",
+    "45 - 64",
+    "65 - 74",
+    "75+",
+    "unknown",
+)
+# Rebinning counts to these classes gives counts per year of age
+SINGLE_YEAR_AGE_CLASSES = tuple(f"{age} - {age}" for age in range(AGE_LIMIT))
+
+_AGE_CLASS = re.compile(r"^\s*(\d+)\s*(?:-\s*(\d+)|(\+))?\s*$")
+
+# Overlap matrices, keyed by source and target classes and by the bytes of the
+# weights, or None for uniform weights
+_OVERLAP_MATRICES: Dict[
+    Tuple[Tuple[str, ...], Tuple[str, ...], Optional[bytes]], np.ndarray
+] = {}
+
+
+def age_interval(age_class: str) -> Optional[Tuple[int, int]]:
+    """Returns the [start, end) years of age_class, e.g. "0 - 9", "80+" or a single
+    year "42", or None if the age is unknown."""
+    if age_class in UNKNOWN_AGES:
+        return None
+    match = _AGE_CLASS.match(age_class)
+    if match is None:
+        raise ValueError(f"Unknown age class {age_class!r}")
+    start, last, open_ended = match.groups()
+    if open_ended:
+        return int(start), AGE_LIMIT
+    return int(start), int(last or start) + 1
+
+
+def age_bars(age_classes: Sequence[str]) -> pd.DataFrame:
+    """Returns the vertical position y and the height of the bar of each age class,
+    classes of unknown age being drawn just above AGE_LIMIT."""
+    bars = []
+    for age_class in age_classes:
+        interval = age_interval(age_class)
+        if interval is None:
+            bars.append((age_class, AGE_LIMIT, 10))
+        else:
+            bars.append((age_class, interval[0], interval[1] - interval[0]))
+    return pd.DataFrame(bars, columns=["age", "y", "height"]).set_index("age")
+
+
+def _membership(age_classes: Sequence[str]) -> np.ndarray:
+    """Returns whether each year of age belongs to each class, as a boolean matrix of
+    shape (classes, AGE_LIMIT + 1), where the last column stands for unknown ages.
+    Years from AGE_LIMIT on are counted in the last year below it."""
+    membership = np.zeros((len(age_classes), AGE_LIMIT + 1), dtype=bool)
+    for i, age_class in enumerate(age_classes):
+        interval = age_interval(age_class)
+        if interval is None:
+            membership[i, AGE_LIMIT] = True
+        else:
+            start = min(interval[0], AGE_LIMIT - 1)
+            membership[i, start : max(min(interval[1], AGE_LIMIT), start + 1)] = True
+    return membership
+
+
+def overlap_matrix(
+    source: Sequence[str],
+    target: Sequence[str],
+    weights: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Returns the share of each source class that falls in each target class, as a
+    matrix of shape (..., len(source), len(target)).
+
+    Counts are spread over the years of each source class uniformly, or in proportion
+    to weights, e.g. a population by year of age, of shape (..., AGE_LIMIT) where the
+    last year counts everyone older. Weights with leading dimensions, e.g. one row
+    per region, give one matrix per row. Unknown ages only map to unknown ages.
+    Matrices are computed once per schemes and weights.
+    """
+    source = tuple(source)
+    target = tuple(target)
+    if weights is not None:
+        weights = np.ascontiguousarray(weights, dtype=np.float64)
+    key = (source, target, None if weights is None else weights.tobytes())
+    matrix = _OVERLAP_MATRICES.get(key)
+    if matrix is None:
+        if weights is None:
+            year_weights = np.ones(AGE_LIMIT + 1)
+        else:
+            unknown = np.ones(weights.shape[:-1] + (1,))
+            year_weights = np.concatenate([weights, unknown], axis=-1)
+        source_weights = _membership(source) * year_weights[..., np.newaxis, :]
+        overlap = source_weights @ _membership(target).T.astype(np.float64)
+        totals = source_weights.sum(axis=-1, keepdims=True)
+        matrix = np.divide(
+            overlap, totals, out=np.zeros_like(overlap), where=totals > 0
+        )
+        _OVERLAP_MATRICES[key] = matrix
+    return matrix
+
+
+def rebin(
+    values: np.ndarray,
+    source: Sequence[str],
+    target: Sequence[str],
+    weights: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Maps counts of shape (..., len(source)) to the target classes, see
+    overlap_matrix. Leading dimensions, e.g. regions or windows, are kept, and
+    match those of weights when it has any."""
+    matrix = overlap_matrix(source, target, weights)
+    return np.einsum("...s,...st->...t", np.asarray(values, dtype=np.float64), matrix)
+
+
+def rebin_frame(
+    frame: pd.DataFrame,
+    target: Sequence[str],
+    weights: Optional[np.ndarray] = None,
+) -> pd.DataFrame:
+    """Maps a frame of counts indexed by age class, like those of get_counts, to the
+    target classes, with the y and height of their bars."""
+    counts = rebin(frame["sumTotal"].to_numpy(), frame.index, target, weights)
+    return pd.DataFrame({"sumTotal": counts}, index=pd.Index(target, name="age")).join(
+        age_bars(target)
+    )
@@ -0,0 +1,431 @@
+"""Benchmark of the pipeline stages on synthetic data, run as python -m
+covid_data.bench.
+
+Synthetic resources in the BAG formats are generated at the requested size and
+served by a local stand-in of the CKAN portal, so that every stage runs as in
+production: package_show, downloads, parsing into the store, loading, cumulative
+indexes, counts and rendering. Each run is appended to a JSON lines results file
+and compared with the last run of the same size.
+"""
+
+import argparse
+import functools
+import http.server
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from . import config
+from .ages import AGE_LIMIT, BAG_AGE_CLASSES, SYMPTOM_AGE_CLASSES
+
+# geoRegion codes of the real resources, further regions get made up codes
+REGIONS = tuple(
+    "CH FL CHFL AG AI AR BE BL BS FR GE GL GR JU LU NE NW OW SG SH SO SZ TG TI UR VD "
+    "VS ZG ZH".split()
+)
+VACCINES = ("all", "pfizer_biontech", "moderna", "johnson_johnson", "novavax")
+SEVERITIES = ("all", "serious", "not_serious")
+FIRST_WEEK = date(2020, 2, 24)
+RESULTS_FILE = "bench_results.jsonl"
+# Identifier and file of each synthetic resource
+RESOURCE_FILES = {
+    "weekly-death-age-range-csv": "death.csv",
+    "weekly-hosp-age-range-csv": "hosp.csv",
+    "daily-vacc-symptoms-csv": "symptoms.csv",
+}
+
+
+def _regions(count: int) -> List[str]:
+    return list(REGIONS[:count]) + [f"X{i:03d}" for i in range(count - len(REGIONS))]
+
+
+def _age_classes(scheme: Sequence[str], count: Optional[int]) -> List[str]:
+    """Returns count age classes in the format of scheme, whose last class is the
+    unknown age: its first known classes, then made up single years from AGE_LIMIT
+    on, which the chart does not draw."""
+    if count is None:
+        return list(scheme)
+    known = list(scheme[:-1])[: count - 1]
+    known += [f"{age} - {age}" for age in range(AGE_LIMIT, AGE_LIMIT + count - 1)]
+    return known[: count - 1] + [scheme[-1]]
+
+
+def _weekly_frame(
+    rng: np.random.Generator,
+    kind: str,
+    weeks: int,
+    regions: List[str],
+    ages: Optional[int] = None,
+) -> pd.DataFrame:
+    """Returns a weekly age range resource, in the columns of the BAG files."""
+    from .series import week_keys
+
+    days = np.datetime64(FIRST_WEEK) + 7 * np.arange(weeks)
+    keys = week_keys(days)
+    ages = _age_classes(BAG_AGE_CLASSES, ages)
+    shape = (len(regions), len(ages), weeks)
+    entries = rng.integers(0, 30, size=shape)
+    totals = entries.cumsum(axis=2)
+    region_column = np.repeat(regions, len(ages) * weeks)
+    age_column = np.tile(np.repeat(ages, weeks), len(regions))
+    datum = np.tile(keys, len(regions) * len(ages))
+    entries = entries.ravel()
+    totals = totals.ravel()
+    return pd.DataFrame(
+        {
+            "altersklasse_covid19": age_column,
+            "datum": datum,
+            "geoRegion": region_column,
+            "entries": entries,
+            "timeframe_all": True,
+            "sumTotal": totals,
+            "timeframe_2w": False,
+            "timeframe_4w": False,
+            "sum2w": entries * 2,
+            "sum4w": entries * 4,
+            "freq": "weekly",
+            "pop": 100000,
+            "inz_entries": entries / 10,
+            "inzsumTotal": totals / 10,
+            "inzsum2w": entries / 5,
+            "inzsum4w": entries / 2.5,
+            "offset_Phase2b": totals // 2,
+            "sumTotal_Phase2b": totals - totals // 2,
+            "inz_sumTotal_Phase2b": (totals - totals // 2) / 10,
+            "type": f"COVID19{kind}",
+            "type_variant": "NA",
+            "datum_unit": "isoweek",
+            "datum_dboardformated": pd.Series(datum // 100).astype(str)
+            + "-"
+            + pd.Series(datum % 100).astype(str).str.zfill(2),
+            "version": "2022-10-04_08-00-00",
+        }
+    )
+
+
+def _symptoms_frame(
+    rng: np.random.Generator,
+    weeks: int,
+    regions: List[str],
+    vaccines: int,
+    severities: int,
+    ages: Optional[int] = None,
+) -> pd.DataFrame:
+    """Returns a daily vaccine adverse effects resource, in the columns of the BAG
+    file."""
+    days = np.datetime_as_string(np.datetime64(FIRST_WEEK) + np.arange(weeks * 7))
+    dimensions = [
+        regions,
+        list(VACCINES[:vaccines]),
+        _age_classes(SYMPTOM_AGE_CLASSES, ages) + ["all"],
+        list(SEVERITIES[:severities]),
+    ]
+    shape = tuple(len(values) for values in dimensions) + (len(days),)
+    entries = rng.integers(0, 5, size=shape)
+    columns = {}
+    for axis, (name, values) in enumerate(
+        zip(["geoRegion", "vaccine", "age_group", "severity"], dimensions)
+    ):
+        inner = int(np.prod(shape[axis + 1 :]))
+        outer = int(np.prod(shape[:axis]))
+        columns[name] = np.tile(np.repeat(values, inner), outer)
+    return pd.DataFrame(
+        {
+            "date": np.tile(days, int(np.prod(shape[:-1]))),
+            **columns,
+            "entries": entries.ravel(),
+            "sumTotal": entries.cumsum(axis=-1).ravel(),
+            "type": "COVID19VaccSymptoms",
+            "version": "2022-10-04",
+        }
+    )
+
+
+def generate(
+    data_dir: str,
+    weeks: int = 140,
+    regions: int = len(REGIONS),
+    vaccines: int = 3,
+    severities: int = 3,
+    seed: int = 1,
+    ages: Optional[int] = None,
+) -> Dict[str, int]:
+    """Writes the synthetic resources to data_dir, and returns their sizes in bytes.
+
+    Resources cover weeks weeks from FIRST_WEEK, for regions geoRegions, and the
+    first vaccines and severities of VACCINES and SEVERITIES. They have the age
+    classes of the BAG files, or ages classes each, see _age_classes.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    region_codes = _regions(regions)
+    frames = {
+        "death.csv": _weekly_frame(rng, "Death", weeks, region_codes, ages),
+        "hosp.csv": _weekly_frame(rng, "Hosp", weeks, region_codes, ages),
+        "symptoms.csv": _symptoms_frame(
+            rng, weeks, region_codes, vaccines, severities, ages
+        ),
+    }
+    sizes = {}
+    for name, frame in frames.items():
+        path = os.path.join(data_dir, name)
+        frame.to_csv(path, index=False)
+        sizes[name] = os.path.getsize(path)
+    return sizes
+
+
+class _PortalHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the files of the data directory, and package_show listing them."""
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        if not self.path.rstrip("/").endswith("/api/action/package_show"):
+            self.send_error(404)
+            return
+        base = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+        resources = []
+        for identifier, name in RESOURCE_FILES.items():
+            modified = os.path.getmtime(os.path.join(self.directory, name))
+            resources.append(
+                {
+                    "identifier": identifier,
+                    "download_url": f"{base}/{name}",
+                    "display_name": {"en": identifier},
+                    "modified": datetime.fromtimestamp(modified).isoformat(),
+                }
+            )
+        body = json.dumps({"success": True, "result": {"resources": resources}})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+
+def serve(data_dir: str) -> Tuple[http.server.ThreadingHTTPServer, str]:
+    """Serves data_dir as a CKAN portal on a free local port, in a daemon thread.
+    Returns the server and the portal URL."""
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(_PortalHandler, directory=data_dir)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def _clear_memos() -> None:
+    from . import population, resources, series, store
+
+    store._RESOURCE_FRAMES.clear()
+    resources._INFERRED_SPECS.clear()
+    series._CUMULATIVE_INDEXES.clear()
+    population._POPULATION_TABLES.clear()
+
+
+def run_stages(api_url: str, windows: int = 100) -> Dict[str, float]:
+    """Runs every stage of the pipeline once, from empty caches, and returns the
+    seconds each one took."""
+    from .chart import ChartRenderer
+    from .ckan import get_resource_map
+    from .counts import (
+        get_all_data,
+        get_counts,
+        get_labels,
+        get_region_counts,
+        get_window_counts,
+    )
+    from .download import cached_download
+    from .series import load_index
+    from .store import ingest_resource, load_resources
+
+    _clear_memos()
+    timings: Dict[str, float] = {}
+
+    def timed(stage: str, function: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        result = function()
+        timings[stage] = time.perf_counter() - start
+        return result
+
+    resource_map = timed("package_show", lambda: get_resource_map(api_url))
+    resources = [resource_map[identifier] for identifier in RESOURCE_FILES]
+    death, hosp, symptoms = resources
+    timed("download", lambda: [cached_download(r["download_url"]) for r in resources])
+    timed("parse", lambda: [ingest_resource(r) for r in resources])
+    timed("load", lambda: load_resources(resources))
+    timed("index", lambda: [load_index(r) for r in resources])
+    start_date, end_date = config.START_DATE, config.END_DATE
+    timed("all_data", lambda: get_all_data(death, hosp, symptoms, end_date))
+    counts = timed(
+        "counts", lambda: get_counts(death, hosp, symptoms, start_date, end_date)
+    )
+    starts = [start_date + timedelta(days=i) for i in range(windows)]
+    timed(
+        "windows",
+        lambda: get_window_counts(
+            death, hosp, symptoms, [(start, end_date) for start in starts]
+        ),
+    )
+    timed(
+        "region_counts",
+        lambda: get_region_counts(death, hosp, symptoms, start_date, end_date),
+    )
+    labels = get_labels(death, hosp, symptoms)
+    renderer = timed("renderer", ChartRenderer)
+    timed(
+        "render",
+        lambda: renderer.render(
+            counts, labels, start_date, end_date, io.BytesIO(), "png"
+        ),
+    )
+    return timings
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(
+    weeks: int = 140,
+    regions: int = len(REGIONS),
+    vaccines: int = 3,
+    severities: int = 3,
+    repeat: int = 3,
+    ages: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Generates and serves the synthetic resources, runs the stages repeat times,
+    each from new caches, and returns the run with the best time of each stage."""
+    sizes = {
+        "weeks": weeks,
+        "regions": regions,
+        "vaccines": vaccines,
+        "severities": severities,
+    }
+    # Runs with the age classes of the BAG files keep the sizes of the earlier ones
+    if ages is not None:
+        sizes["ages"] = ages
+    work_dir = tempfile.mkdtemp(prefix="covid_data_bench.")
+    cache_dir = config.CACHE_DIR
+    server = None
+    try:
+        data_dir = os.path.join(work_dir, "data")
+        file_sizes = generate(data_dir, **sizes)
+        server, api_url = serve(data_dir)
+        runs = []
+        for i in range(repeat):
+            config.set_cache_dir(os.path.join(work_dir, f"cache{i}"))
+            runs.append(run_stages(api_url))
+    finally:
+        config.set_cache_dir(cache_dir)
+        _clear_memos()
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "sizes": sizes,
+        "bytes": file_sizes,
+        "repeat": repeat,
+        "seconds": {stage: min(run[stage] for run in runs) for stage in runs[0]},
+    }
+
+
+def _previous_run(path: str, sizes: Dict[str, int]) -> Optional[Dict[str, Any]]:
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                result = json.loads(line)
+                if result["sizes"] == sizes:
+                    previous = result
+    return previous
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m covid_data.bench",
+        description="Time each stage of the pipeline on synthetic data, and compare "
+        "with the previous run of the same size.",
+    )
+    parser.add_argument("--weeks", type=int, default=140, help="(default: %(default)s)")
+    parser.add_argument(
+        "--regions", type=int, default=len(REGIONS), help="(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--vaccines",
+        type=int,
+        default=3,
+        choices=range(1, len(VACCINES) + 1),
+        help="(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--severities",
+        type=int,
+        default=3,
+        choices=range(1, len(SEVERITIES) + 1),
+        help="(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--ages",
+        type=int,
+        help="age classes of each resource, unknown age included (default: those "
+        "of the BAG files)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per stage (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--results",
+        default=RESULTS_FILE,
+        help="JSON lines file the results are appended to (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+    if args.ages is not None and args.ages < 1:
+        parser.error("--ages must be at least 1")
+
+    result = benchmark(
+        args.weeks,
+        args.regions,
+        args.vaccines,
+        args.severities,
+        args.repeat,
+        args.ages,
+    )
+    previous = _previous_run(args.results, result["sizes"])
+    print(f"{'stage':<14}{'seconds':>10}{'previous':>10}{'ratio':>8}")
+    for stage, seconds in result["seconds"].items():
+        line = f"{stage:<14}{seconds:>10.4f}"
+        if previous is not None and stage in previous["seconds"]:
+            before = previous["seconds"][stage]
+            line += f"{before:>10.4f}{seconds / before:>8.2f}"
+        print(line)
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Sources of the resource files: their own downloads, or members of the bundle.
+
+opendata.swiss also publishes the dataset as one versioned ZIP archive of all its
+CSV files. When config.BUNDLE is set, get_resource_map points the resources found
+in BUNDLE_MEMBERS to their member of the archive, which is downloaded once per
+version instead of every resource on its own. Members are streamed from the
+archive into the parser, without being extracted.
+"""
+
+import functools
+import os
+import shutil
+import threading
+import zipfile
+from typing import IO, Any, Callable, Dict, Optional
+
+from . import config
+from .download import cached_download
+
+# File of each resource in the bundle, matched against the base names of its
+# members
+BUNDLE_MEMBERS = {
+    "daily-cases-csv": "COVID19Cases_geoRegion.csv",
+    "daily-hosp-csv": "COVID19Hosp_geoRegion.csv",
+    "daily-death-csv": "COVID19Death_geoRegion.csv",
+    "daily-test-csv": "COVID19Test_geoRegion_all.csv",
+    "daily-hosp-capacity-csv": "COVID19HospCapacity_geoRegion.csv",
+    "daily-vacc-doses-administered-csv": "COVID19VaccDosesAdministered.csv",
+    "daily-vacc-symptoms-csv": "COVID19VaccSymptoms.csv",
+    "weekly-cases-age-range-csv": "COVID19Cases_geoRegion_AKL10_w.csv",
+    "weekly-hosp-age-range-csv": "COVID19Hosp_geoRegion_AKL10_w.csv",
+    "weekly-death-age-range-csv": "COVID19Death_geoRegion_AKL10_w.csv",
+    "weekly-test-age-range-csv": "COVID19Test_geoRegion_AKL10_w.csv",
+    "weekly-cases-sex-csv": "COVID19Cases_geoRegion_sex_w.csv",
+    "weekly-hosp-sex-csv": "COVID19Hosp_geoRegion_sex_w.csv",
+    "weekly-death-sex-csv": "COVID19Death_geoRegion_sex_w.csv",
+    "weekly-vacc-persons-age-range-csv": "COVID19VaccPersons_AKL10_w_v2.csv",
+}
+
+_BUNDLE_LOCK = threading.Lock()
+
+
+def bundle_version(bundle: Dict[str, Any]) -> str:
+    # store imports this module
+    from .store import resource_modified, version_key
+
+    return version_key(resource_modified(bundle))
+
+
+def cached_bundle(bundle: Dict[str, Any]) -> str:
+    """Returns the path of the archive of bundle, kept in config.BUNDLE_CACHE_DIR
+    under its version, and downloaded only when that version is not there yet.
+    Archives of the other versions are removed."""
+    os.makedirs(config.BUNDLE_CACHE_DIR, exist_ok=True)
+    path = os.path.join(config.BUNDLE_CACHE_DIR, f"{bundle_version(bundle)}.zip")
+    with _BUNDLE_LOCK:
+        if os.path.exists(path):
+            return path
+        body_path = cached_download(bundle["download_url"])
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.link(body_path, tmp_path)
+        except OSError:
+            shutil.copyfile(body_path, tmp_path)
+        os.replace(tmp_path, path)
+        for entry in os.listdir(config.BUNDLE_CACHE_DIR):
+            if entry.endswith(".zip") and entry != os.path.basename(path):
+                try:
+                    os.remove(os.path.join(config.BUNDLE_CACHE_DIR, entry))
+                except FileNotFoundError:
+                    pass
+    return path
+
+
+def bundle_resources(
+    resource_map: Dict[str, Dict[str, Any]], bundle_id: Optional[str] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Returns resource_map where the resources of BUNDLE_MEMBERS are read from the
+    bundle resource bundle_id, by default config.BUNDLE_RESOURCE. They get the
+    version of the bundle, and a download URL of their own within it, which the
+    memory caches are keyed by."""
+    bundle = resource_map[bundle_id or config.BUNDLE_RESOURCE]
+    resources = dict(resource_map)
+    for identifier, member in BUNDLE_MEMBERS.items():
+        if identifier not in resources:
+            continue
+        resources[identifier] = dict(
+            resources[identifier],
+            bundle=bundle,
+            member=member,
+            download_url=f"{bundle['download_url']}#{member}",
+            modified=bundle_version(bundle),
+        )
+    return resources
+
+
+def _open_member(path: str, member: str) -> IO[bytes]:
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if os.path.basename(info.filename) == member:
+                # The member keeps the archive file open until it is closed
+                return archive.open(info)
+    raise KeyError(f"{member} is not in the bundle {path}")
+
+
+def resource_opener(resource: Dict[str, Any]) -> Callable[[], IO[bytes]]:
+    """Fetches the file of resource, downloading it or its bundle when needed, and
+    returns a function opening it for binary reading, as many times as needed.
+    Bundle members are decompressed while being read, and can only be seeked
+    forward efficiently."""
+    if "member" in resource:
+        path = cached_bundle(resource["bundle"])
+        return functools.partial(_open_member, path, resource["member"])
+    return functools.partial(open, cached_download(resource["download_url"]), "rb")
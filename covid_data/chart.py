@@ -0,0 +1,372 @@
+"""Rendering of the comparison chart."""
+
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from typing import IO, Any, Dict, List, Optional, Sequence, Union
+
+import pandas as pd
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+
+from . import config
+from .counts import AGE_BARS, CovidData, get_counts, get_labels
+from .metrics import stage
+
+DEATH_COLOR = (0.1, 0.2, 0.4)
+HOSP_COLOR = (0.1, 0.2, 0.8)
+SYMPTOM_COLOR = (0.1, 0.8, 0.2)
+DEATH_UNKNOWN_COLOR = (0.5, 0.5, 0.5)
+HOSP_UNKNOWN_COLOR = (0.6, 0.6, 0.6)
+SYMPTOM_UNKNOWN_COLOR = (0.7, 0.7, 0.7)
+TRANSPARENT_COLOR = (0, 0, 0, 0)
+# How regions are named in the chart legend, when not by their geoRegion code
+REGION_LABELS = {"CHFL": "CH + FL"}
+
+# A chart to render in a worker process, from precomputed counts and labels, going
+# through the chart cache in cache_dir, config.RENDER_CACHE_DIR by default
+ChartJob = namedtuple(
+    "ChartJob",
+    [
+        "counts",
+        "labels",
+        "start_date",
+        "end_date",
+        "output",
+        "format",
+        "region",
+        "cache_dir",
+    ],
+    defaults=("CHFL", None),
+)
+# Outcome of a ChartJob: data holds the chart when the job had no output path, and
+# error the failure message when it could not be rendered
+ChartResult = namedtuple("ChartResult", ["output", "data", "seconds", "error"])
+
+
+def draw_chart(
+    fig: Figure,
+    plot: Axes,
+    counts: CovidData,
+    labels: CovidData,
+    start_date: date,
+    end_date: date,
+    region: str = "CHFL",
+) -> None:
+    fig.suptitle(f"COVID / Vaccine comparison by age, {start_date} - {end_date}")
+    fig.set_size_inches(19, 11, forward=True)
+    death_known = counts.death
+    death_known = death_known[(death_known.index != "Unbekannt")]
+    b = plot.barh(
+        y=death_known.y,
+        width=-death_known.sumTotal / death_known.height,
+        left=0,
+        height=death_known.height,
+        align="edge",
+        color=DEATH_COLOR,
+        edgecolor=(0, 0, 0),
+        linewidth=1,
+        label=f"COVID deaths ({labels.death}).",
+    )
+    death_unknown = counts.death
+    death_unknown = death_unknown[(death_unknown.index == "Unbekannt")]
+    if counts.death.sumTotal.get("Unbekannt", 0) > 0:
+        b = plot.barh(
+            y=death_unknown.y,
+            width=-death_unknown.sumTotal / death_unknown.height,
+            left=0,
+            height=death_unknown.height,
+            align="edge",
+            color=DEATH_UNKNOWN_COLOR,
+            edgecolor=(0, 0, 0),
+            linewidth=1,
+            label="Death with unknown age.",
+        )
+    hosp_known = counts.hosp
+    hosp_known = hosp_known[(hosp_known.index != "Unbekannt")]
+    b = plot.barh(
+        y=hosp_known.y,
+        width=-hosp_known.sumTotal / hosp_known.height,
+        left=-death_known.sumTotal / death_known.height,
+        height=hosp_known.height,
+        align="edge",
+        color=HOSP_COLOR,
+        edgecolor=(0, 0, 0),
+        linewidth=1,
+        label=f"COVID hospitalizations ({labels.hosp}).",
+    )
+    plot.bar_label(b, hosp_known.sumTotal + death_known.sumTotal)
+    if counts.hosp.sumTotal.get("Unbekannt", 0) > 0:
+        hosp_unknown = counts.hosp
+        hosp_unknown = hosp_unknown[(hosp_unknown.index == "Unbekannt")]
+        # Deaths of unknown age may have no row, and then no bar to stack on
+        death_unknown_total = death_unknown.sumTotal.sum()
+        b = plot.barh(
+            y=hosp_unknown.y,
+            width=-hosp_unknown.sumTotal / hosp_unknown.height,
+            left=-(death_unknown.sumTotal / death_unknown.height).sum(),
+            height=hosp_unknown.height,
+            align="edge",
+            color=HOSP_UNKNOWN_COLOR,
+            edgecolor=(0, 0, 0),
+            linewidth=1,
+            label="Hospitalization with unknown age.",
+        )
+        plot.bar_label(b, hosp_unknown.sumTotal + death_unknown_total)
+    symptom_known = counts.symptoms
+    symptom_known = symptom_known[(symptom_known.index != "unknown")]
+    # Regions without vaccine adverse effect data only get the COVID bars
+    if not symptom_known.empty:
+        b = plot.barh(
+            y=symptom_known.y,
+            width=symptom_known.sumTotal / symptom_known.height,
+            left=0,
+            height=symptom_known.height,
+            align="edge",
+            color=SYMPTOM_COLOR,
+            edgecolor=(0, 0, 0),
+            linewidth=1,
+            label=f"Reported vaccine adverse effects ({labels.symptoms}).",
+        )
+        plot.bar_label(b, symptom_known.sumTotal)
+    if counts.symptoms.sumTotal.get("unknown", 0) > 0:
+        symptom_unknown = counts.symptoms
+        symptom_unknown = symptom_unknown[(symptom_unknown.index == "unknown")]
+        b = plot.barh(
+            y=symptom_unknown.y,
+            width=symptom_unknown.sumTotal / symptom_unknown.height,
+            left=0,
+            height=symptom_unknown.height,
+            align="edge",
+            color=SYMPTOM_UNKNOWN_COLOR,
+            edgecolor=(0, 0, 0),
+            linewidth=1,
+            label="Adverse effects with unknown age.",
+        )
+        plot.bar_label(b, symptom_unknown.sumTotal)
+
+    plot.xaxis.set_visible(False)
+    plot.set_ylabel("Age")
+    plot.set_yticks([0, 20, 40, 60, 80])
+    fig.legend()
+    more_legends =f"""
+Data Source: opendata.swiss , package '{config.DATASET_NAME}'
+Data for {REGION_LABELS.get(region, region)}
+Code Source: https://github.com/deedf/covid_data
+Generated on {datetime.now().strftime('%Y-%m-%d')}
+"""
+    fig.legend([Rectangle(xy=(0, 0), width=10, height=10, color=TRANSPARENT_COLOR)],[more_legends], fontsize="small", loc="lower center")
+    plot.margins(0.1, 0.1)
+    plot.spines["top"].set_visible(False)
+    plot.spines["right"].set_visible(False)
+    plot.spines["bottom"].set_visible(False)
+
+
+class ChartRenderer:
+    """Renders charts off screen with the Agg backend.
+
+    The same figure and axes are cleared and drawn again for every chart, so that
+    many charts can be rendered in one process without going through pyplot.
+    """
+
+    def __init__(self) -> None:
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.plot = self.figure.add_subplot()
+
+    @stage("render")
+    def render(
+        self,
+        counts: CovidData,
+        labels: CovidData,
+        start_date: date,
+        end_date: date,
+        output: Union[str, IO[bytes], None] = None,
+        format: str = "png",
+        region: str = "CHFL",
+    ) -> Optional[bytes]:
+        """Writes the chart to output, a path or a binary file object, in format
+        (png, svg or pdf). Returns the chart as bytes when output is None."""
+        self.plot.clear()
+        self.figure.legends.clear()
+        draw_chart(
+            self.figure, self.plot, counts, labels, start_date, end_date, region
+        )
+        if output is not None:
+            self.figure.savefig(output, format=format)
+            return None
+        buffer = io.BytesIO()
+        self.figure.savefig(buffer, format=format)
+        return buffer.getvalue()
+
+
+def chart_key(
+    counts: CovidData,
+    labels: CovidData,
+    start_date: date,
+    end_date: date,
+    format: str,
+    region: str = "CHFL",
+) -> str:
+    """Returns a digest of everything a chart is drawn from."""
+    digest = hashlib.sha256()
+    for frame in (*counts, AGE_BARS):
+        digest.update(repr(list(frame.columns)).encode("utf-8"))
+        digest.update(pd.util.hash_pandas_object(frame).to_numpy().tobytes())
+    colors = (
+        DEATH_COLOR,
+        HOSP_COLOR,
+        SYMPTOM_COLOR,
+        DEATH_UNKNOWN_COLOR,
+        HOSP_UNKNOWN_COLOR,
+        SYMPTOM_UNKNOWN_COLOR,
+        TRANSPARENT_COLOR,
+    )
+    texts = (
+        tuple(labels),
+        config.DATASET_NAME,
+        REGION_LABELS.get(region, region),
+        start_date,
+        end_date,
+        format,
+    )
+    digest.update(repr((colors, texts)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _evict_charts(cache_dir: str, max_bytes: int) -> None:
+    """Removes the least recently used charts until cache_dir fits in max_bytes."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".tmp"):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cached_render(
+    renderer: ChartRenderer,
+    counts: CovidData,
+    labels: CovidData,
+    start_date: date,
+    end_date: date,
+    format: str = "png",
+    region: str = "CHFL",
+    cache_dir: Optional[str] = None,
+    max_bytes: Optional[int] = None,
+) -> bytes:
+    """Returns the chart from cache_dir, rendering and storing it on a miss.
+
+    Charts are keyed by a hash of their counts, AGE_BARS, colors and texts. A hit
+    refreshes the modification time of the file, which the eviction of the least
+    recently used charts relies on.
+    """
+    cache_dir = cache_dir or config.RENDER_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    key = chart_key(counts, labels, start_date, end_date, format, region)
+    path = os.path.join(cache_dir, f"{key}.{format}")
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        return data
+    except FileNotFoundError:
+        pass
+    data = renderer.render(
+        counts, labels, start_date, end_date, format=format, region=region
+    )
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    _evict_charts(cache_dir, max_bytes or config.RENDER_CACHE_SIZE)
+    return data
+
+
+# Renderer of the current process, created by its first chart
+_WORKER_RENDERER: Optional[ChartRenderer] = None
+
+
+def render_job(job: ChartJob) -> ChartResult:
+    global _WORKER_RENDERER
+    started = time.perf_counter()
+    try:
+        if _WORKER_RENDERER is None:
+            _WORKER_RENDERER = ChartRenderer()
+        data = cached_render(
+            _WORKER_RENDERER,
+            job.counts,
+            job.labels,
+            job.start_date,
+            job.end_date,
+            job.format,
+            job.region,
+            job.cache_dir,
+        )
+        if job.output is not None:
+            with open(job.output, "wb") as f:
+                f.write(data)
+            data = None
+    except Exception as e:
+        return ChartResult(job.output, None, time.perf_counter() - started, repr(e))
+    return ChartResult(job.output, data, time.perf_counter() - started, None)
+
+
+def render_charts(
+    jobs: Sequence[ChartJob], workers: Optional[int] = None
+) -> List[ChartResult]:
+    """Renders jobs on a pool of worker processes, one per core by default, and
+    returns their results in the same order.
+
+    Workers only receive the counts of their charts. A failing chart is reported
+    in its result and does not stop the others.
+    """
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return list(pool.map(render_job, jobs))
+
+
+def build_graph(
+    death: Dict[str, Any], hosp: Dict[str, Any], symptoms: Dict[str, Any]
+) -> None:
+    """Shows the chart in a notebook, from the chart cache when it is unchanged."""
+    global _WORKER_RENDERER
+    counts = get_counts(death, hosp, symptoms, config.START_DATE, config.END_DATE)
+    if _WORKER_RENDERER is None:
+        _WORKER_RENDERER = ChartRenderer()
+    data = cached_render(
+        _WORKER_RENDERER,
+        counts,
+        get_labels(death, hosp, symptoms),
+        config.START_DATE,
+        config.END_DATE,
+    )
+    try:
+        from IPython.display import Image, display
+    except ImportError:
+        # pyplot is only needed to show the chart outside of a notebook
+        import matplotlib.pyplot as plt
+
+        figure = plt.figure(figsize=(19, 11))
+        figure.figimage(plt.imread(io.BytesIO(data)))
+        plt.show()
+        return
+    display(Image(data))
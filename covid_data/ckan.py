@@ -0,0 +1,75 @@
+"""Resource metadata of the dataset on the CKAN portal."""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from . import config
+from .metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+def _resource_map(package: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    resource_map = dict([(r["identifier"], r) for r in package["resources"]])
+    if config.BUNDLE:
+        from .bundle import bundle_resources
+
+        resource_map = bundle_resources(resource_map)
+    return resource_map
+
+
+def get_resource_map(
+    api_url: Optional[str] = None, dataset_name: Optional[str] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Returns the resources of the dataset, keyed by identifier.
+
+    The package_show result is cached in config.METADATA_CACHE_DIR and the portal
+    is only called again once the cached copy is older than config.METADATA_TTL.
+    When the portal fails or is offline, the cached copy is used whatever its age.
+    With config.BUNDLE, resources are read from the bundle, see
+    bundle.bundle_resources.
+    """
+    api_url = api_url or config.CKAN_API_URL
+    dataset_name = dataset_name or config.DATASET_NAME
+    key = hashlib.sha256(f"{api_url} {dataset_name}".encode("utf-8")).hexdigest()
+    path = os.path.join(config.METADATA_CACHE_DIR, key + ".json")
+    cached: Optional[Dict[str, Any]] = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if config.OFFLINE or time.time() - cached["fetched"] < config.METADATA_TTL:
+            return _resource_map(cached["package"])
+    if config.OFFLINE:
+        raise FileNotFoundError(f"No cached metadata for {dataset_name} at {api_url}")
+
+    import requests
+    from ckanapi import RemoteCKAN
+    from ckanapi.errors import CKANAPIError
+
+    try:
+        with stage("package_show"):
+            package = RemoteCKAN(api_url).call_action(
+                "package_show",
+                {"name_or_id": dataset_name},
+                requests_kwargs={"timeout": config.METADATA_TIMEOUT},
+            )
+    except (CKANAPIError, requests.RequestException) as e:
+        if cached is None:
+            raise
+        logger.warning(
+            "package_show %s failed (%s), using the metadata cached %.0fs ago",
+            dataset_name,
+            e,
+            time.time() - cached["fetched"],
+        )
+        return _resource_map(cached["package"])
+    os.makedirs(config.METADATA_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"fetched": time.time(), "package": package}, f)
+    os.replace(tmp_path, path)
+    return _resource_map(package)
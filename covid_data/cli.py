@@ -0,0 +1,352 @@
+"""Command line interface, run as python -m covid_data or covid-data.
+
+Each command only imports the stages it runs: data commands never load
+matplotlib, and ckanapi is only loaded to fetch the resource metadata.
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import config
+
+# Resources compared by the chart, in the argument order of get_counts
+RESOURCE_IDS = (
+    "weekly-death-age-range-csv",
+    "weekly-hosp-age-range-csv",
+    "daily-vacc-symptoms-csv",
+)
+DEFAULT_CHART_OUTPUT = "covid_{region}_{start}_{end}.{format}"
+
+
+def _get_resources() -> List[Dict[str, Any]]:
+    from .ckan import get_resource_map
+
+    resource_map = get_resource_map()
+    return [resource_map[identifier] for identifier in RESOURCE_IDS]
+
+
+def _region_counts(
+    resources: List[Dict[str, Any]],
+    start_date: date,
+    end_date: date,
+    regions: List[str],
+) -> Dict[str, Any]:
+    """Returns the counts of every region, or the KeyError of the regions without
+    data, computed from one cube for all of them. The region all stands for every
+    geoRegion of the resources."""
+    from .counts import get_region_counts, region_counts
+
+    cube = get_region_counts(
+        *resources, start_date, end_date, None if "all" in regions else regions
+    )
+    counts = {}
+    for region in cube.index.levels[0]:
+        try:
+            counts[region] = region_counts(cube, region)
+        except KeyError as e:
+            counts[region] = e
+    return counts
+
+
+def _write_counts(
+    resources: List[Dict[str, Any]],
+    start_date: date,
+    end_date: date,
+    regions: List[str],
+    output: Optional[str],
+    rates: bool = False,
+) -> bool:
+    """Writes the counts of every region, with their rates per 100k inhabitants if
+    rates, and returns whether they all exist."""
+    import pandas as pd
+
+    from .counts import CovidData
+
+    frames = {}
+    region_counts = _region_counts(resources, start_date, end_date, regions)
+    for region, counts in region_counts.items():
+        if isinstance(counts, KeyError):
+            print(f"{region}: failed, {counts.args[0]}", file=sys.stderr)
+            continue
+        frames[region] = pd.concat(
+            counts, keys=CovidData._fields, names=["series", "age"]
+        )
+    if frames:
+        frame = pd.concat(frames.values(), keys=frames.keys(), names=["region"])
+        if rates:
+            from .population import add_rates, load_population
+
+            frame = add_rates(frame, load_population(resources[0]))
+        frame.to_csv(output or sys.stdout)
+    return len(frames) == len(region_counts)
+
+
+def _chart_jobs(
+    resources: List[Dict[str, Any]],
+    start_date: date,
+    end_date: date,
+    regions: List[str],
+    output: str,
+    format: Optional[str],
+) -> Tuple[List[Any], bool]:
+    """Returns the chart jobs of every region and whether they all have data,
+    reporting on stderr the regions without data, which get no job."""
+    from .chart import ChartJob
+    from .counts import get_labels
+
+    labels = get_labels(*resources)
+    jobs = []
+    region_counts = _region_counts(resources, start_date, end_date, regions)
+    for region, counts in region_counts.items():
+        path = output.format(
+            region=region, start=start_date, end=end_date, format=format or "png"
+        )
+        if isinstance(counts, KeyError):
+            print(f"{path}: failed, {counts.args[0]}", file=sys.stderr)
+            continue
+        jobs.append(
+            ChartJob(
+                counts,
+                labels,
+                start_date,
+                end_date,
+                path,
+                format or os.path.splitext(path)[1][1:] or "png",
+                region,
+                config.RENDER_CACHE_DIR,
+            )
+        )
+    return jobs, len(jobs) == len(region_counts)
+
+
+def _render(jobs: List[Any], workers: int) -> bool:
+    """Renders jobs, reporting each chart on stderr, and returns whether they all
+    succeeded."""
+    from .chart import render_charts, render_job
+
+    if workers == 1:
+        results = [render_job(job) for job in jobs]
+    else:
+        results = render_charts(jobs, workers)
+    for result in results:
+        if result.error is None:
+            print(f"{result.output}: {result.seconds:.2f}s", file=sys.stderr)
+        else:
+            print(f"{result.output}: failed, {result.error}", file=sys.stderr)
+    return all(result.error is None for result in results)
+
+
+def _counts(args: argparse.Namespace) -> int:
+    resources = _get_resources()
+    ok = _write_counts(
+        resources, args.start, args.end, args.region, args.output, args.rates
+    )
+    return 0 if ok else 1
+
+
+def _chart(args: argparse.Namespace) -> int:
+    jobs, ok = _chart_jobs(
+        _get_resources(), args.start, args.end, args.region, args.output, args.format
+    )
+    return 0 if _render(jobs, args.workers) and ok else 1
+
+
+def _entry_window(entry: Dict[str, Any]) -> Tuple[date, date]:
+    """Returns the window of a manifest entry, raising ValueError when its dates are
+    not YYYY-MM-DD or its start is after its end."""
+    start_date = date.fromisoformat(entry.get("start", config.START_DATE.isoformat()))
+    end_date = date.fromisoformat(entry.get("end", config.END_DATE.isoformat()))
+    if start_date > end_date:
+        raise ValueError(f"start {start_date} is after end {end_date}")
+    return start_date, end_date
+
+
+def _batch(args: argparse.Namespace) -> int:
+    """Runs every job of the manifest, loading each resource only once."""
+    with open(args.manifest, encoding="utf-8") as f:
+        manifest = json.load(f)
+    resources = _get_resources()
+    jobs = []
+    ok = True
+    for number, entry in enumerate(manifest):
+        try:
+            start_date, end_date = _entry_window(entry)
+        except ValueError as e:
+            print(f"{args.manifest}[{number}]: failed, {e}", file=sys.stderr)
+            ok = False
+            continue
+        regions = entry.get("region", ["CHFL"])
+        if isinstance(regions, str):
+            regions = [regions]
+        if entry.get("command", "chart") == "counts":
+            output = entry.get("output")
+            rates = entry.get("rates", False)
+            ok &= _write_counts(resources, start_date, end_date, regions, output, rates)
+        else:
+            entry_jobs, entry_ok = _chart_jobs(
+                resources,
+                start_date,
+                end_date,
+                regions,
+                entry.get("output", DEFAULT_CHART_OUTPUT),
+                entry.get("format"),
+            )
+            ok &= entry_ok
+            jobs += entry_jobs
+    return 0 if _render(jobs, args.workers) and ok else 1
+
+
+def _serve(args: argparse.Namespace) -> int:
+    import logging
+
+    from .service import serve
+
+    logging.basicConfig(level=logging.INFO)
+    serve(args.port, args.address)
+    return 0
+
+
+def _add_window_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "-s",
+        "--start",
+        type=date.fromisoformat,
+        default=config.START_DATE,
+        help="start of the window, YYYY-MM-DD (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-e",
+        "--end",
+        type=date.fromisoformat,
+        default=config.END_DATE,
+        help="end of the window, YYYY-MM-DD (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-r",
+        "--region",
+        action="append",
+        help="geoRegion to compute, may be repeated, or all for every geoRegion "
+        "(default: CHFL)",
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="covid_data",
+        description="Compare COVID hospitalizations and deaths with reported vaccine "
+        "adverse effects, by age class.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=config.CACHE_DIR,
+        help="directory of the download, data and chart caches (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="only use cached metadata and data, without any network access",
+    )
+    parser.add_argument(
+        "--bundle",
+        action="store_true",
+        help="read the resources from the ZIP bundle of the whole dataset, "
+        "downloaded once per version",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve the stage metrics for Prometheus on this port while running",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        help="write the stage metrics to this file when done, for the node exporter "
+        "textfile collector",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    counts = commands.add_parser("counts", help="write the chart counts as CSV")
+    _add_window_arguments(counts)
+    counts.add_argument("-o", "--output", help="CSV file, standard output by default")
+    counts.add_argument(
+        "--rates",
+        action="store_true",
+        help="add the counts per 100k inhabitants of the region and age class",
+    )
+    counts.set_defaults(func=_counts)
+
+    chart = commands.add_parser("chart", help="render the chart to files")
+    _add_window_arguments(chart)
+    chart.add_argument(
+        "-o",
+        "--output",
+        default=DEFAULT_CHART_OUTPUT,
+        help="image file name, where {region}, {start}, {end} and {format} are "
+        "replaced (default: %(default)s)",
+    )
+    chart.add_argument(
+        "-f",
+        "--format",
+        choices=("png", "svg", "pdf"),
+        help="image format, guessed from the output file name by default",
+    )
+    chart.set_defaults(func=_chart)
+
+    batch = commands.add_parser(
+        "batch",
+        help="run the jobs of a manifest in one process",
+        description="The manifest is a JSON list of jobs, objects with the keys "
+        "command (chart or counts), start, end, region (a code or a list of codes), "
+        "output, format and rates, with the same defaults as the commands.",
+    )
+    batch.add_argument("manifest", help="JSON manifest file")
+    batch.set_defaults(func=_batch)
+
+    serve = commands.add_parser(
+        "serve",
+        help="serve the chart and its counts over HTTP",
+        description="Serves GET /chart?start=&end=&region=&format= and the counts "
+        "behind it at /counts, see covid_data.service, from data kept in memory and "
+        "refreshed in the background.",
+    )
+    serve.add_argument(
+        "-p", "--port", type=int, default=8080, help="(default: %(default)s)"
+    )
+    serve.add_argument(
+        "--address", default="", help="address to listen on (default: all)"
+    )
+    serve.set_defaults(func=_serve)
+
+    for command in (chart, batch):
+        command.add_argument(
+            "-j",
+            "--workers",
+            type=int,
+            default=1,
+            help="render charts on this many processes (default: %(default)s)",
+        )
+
+    args = parser.parse_args(argv)
+    config.set_cache_dir(args.cache_dir)
+    config.OFFLINE = args.offline
+    config.BUNDLE = args.bundle
+    if "region" in args and args.region is None:
+        args.region = ["CHFL"]
+    if "start" in args and args.start > args.end:
+        parser.error(f"the start {args.start} is after the end {args.end}")
+    if args.metrics_port is not None or args.metrics_textfile is not None:
+        from .metrics import get_registry, start_exporter
+
+        # Stages measure the resident set size once the registry exists
+        get_registry()
+        if args.metrics_port is not None:
+            start_exporter(args.metrics_port)
+    status = args.func(args)
+    if args.metrics_textfile is not None:
+        from .metrics import write_textfile
+
+        write_textfile(args.metrics_textfile)
+    sys.exit(status)
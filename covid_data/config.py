@@ -0,0 +1,77 @@
+"""Settings shared by the covid_data modules."""
+
+import os
+from datetime import date
+
+DATASET_NAME = "covid-19-schweiz"
+CKAN_API_URL = "https://ckan.opendata.swiss/"
+
+START_DATE = date(2021, 3, 23)
+END_DATE = date(2022, 4, 5)
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "covid_data")
+# When set, nothing is fetched from the network and only cached data is used
+OFFLINE = False
+# The dataset metadata is kept here and fetched again once older than METADATA_TTL
+# seconds, or when the cached copy is needed offline, used whatever its age
+METADATA_CACHE_DIR = os.path.join(CACHE_DIR, "metadata")
+METADATA_TTL = 3600
+METADATA_TIMEOUT = 10
+# Downloaded resources are kept here and revalidated on each run
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, "http")
+HTTP_TIMEOUT = 60
+HTTP_CHUNK_SIZE = 1 << 20
+# Cache entries are only locked for a moment, so a lock held for longer than this,
+# in seconds, was left by a process killed meanwhile, and is broken
+HTTP_LOCK_TIMEOUT = 30
+# When set, the resources are read from the bundle ZIP of the whole dataset,
+# resource BUNDLE_RESOURCE, kept in BUNDLE_CACHE_DIR by version
+BUNDLE = False
+BUNDLE_RESOURCE = "sources-csv-zip"
+BUNDLE_CACHE_DIR = os.path.join(CACHE_DIR, "bundles")
+# Columnar copies of the resources, one Parquet dataset per resource version
+STORE_DIR = os.path.join(CACHE_DIR, "store")
+# Resources are parsed this many rows at a time, which bounds the parser memory
+# whatever the size of the files
+CSV_CHUNK_ROWS = 1 << 18
+# Specs of the resources missing from resources.RESOURCE_SPECS are inferred from
+# this many rows
+SPEC_SAMPLE_ROWS = 10000
+# Resources are stored as blocks of lines cut where the content of a line hashes to
+# a multiple of STORE_BLOCK_LINES, so that a republished resource only has the
+# blocks around its new or revised rows parsed again. Blocks have at most
+# 4 * STORE_BLOCK_LINES lines, parsed at once, and are hashed STORE_SCAN_BYTES at a
+# time.
+STORE_BLOCK_LINES = 1 << 16
+STORE_SCAN_BYTES = 2 << 20
+# Temporary directories of the store older than this, in seconds, are left by
+# ingests that did not finish, and are removed
+STORE_TMP_MAX_AGE = 24 * 3600
+# Population by geoRegion and age, for rates: a CSV file with columns geoRegion, age
+# (single years or any age classes, see ages.age_interval) and pop, or None to use
+# the pop column of the weekly death resource
+POPULATION_FILE = None
+# Rendered charts are kept here, up to RENDER_CACHE_SIZE bytes
+RENDER_CACHE_DIR = os.path.join(CACHE_DIR, "charts")
+RENDER_CACHE_SIZE = 256 << 20
+# The chart service checks for republished resources this often, in seconds, see
+# also METADATA_TTL
+SERVICE_REFRESH = 600
+# Counts queries of the chart service are rejected above this many windows times
+# regions
+SERVICE_MAX_COUNTS = 20000
+# Resources are fetched concurrently, with at most this many requests per host
+DOWNLOAD_WORKERS = 8
+DOWNLOADS_PER_HOST = 4
+
+
+def set_cache_dir(path: str) -> None:
+    """Moves all the caches under path."""
+    global CACHE_DIR, METADATA_CACHE_DIR, HTTP_CACHE_DIR, BUNDLE_CACHE_DIR
+    global STORE_DIR, RENDER_CACHE_DIR
+    CACHE_DIR = path
+    METADATA_CACHE_DIR = os.path.join(path, "metadata")
+    HTTP_CACHE_DIR = os.path.join(path, "http")
+    BUNDLE_CACHE_DIR = os.path.join(path, "bundles")
+    STORE_DIR = os.path.join(path, "store")
+    RENDER_CACHE_DIR = os.path.join(path, "charts")
@@ -0,0 +1,225 @@
+"""Hospitalization, death and vaccine adverse effect counts by age class."""
+
+from collections import namedtuple
+from datetime import date
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .ages import BAG_AGE_CLASSES, SYMPTOM_AGE_CLASSES, age_bars, rebin_frame
+from .metrics import stage
+from .series import get_delta, get_total, load_index, region_position, time_positions
+from .store import load_resources
+
+CovidData = namedtuple("CovidData", ["hosp", "death", "symptoms"])
+
+# Used to pick the vertical position and height of each age class
+AGE_BARS = age_bars(BAG_AGE_CLASSES + SYMPTOM_AGE_CLASSES)
+
+
+@stage("counts")
+def get_all_data(
+    death: Dict[str, Any], hosp: Dict[str, Any], symptoms: Dict[str, Any], at_date: date
+) -> CovidData:
+    return CovidData(
+        get_total(hosp, at_date),
+        get_total(death, at_date),
+        get_total(symptoms, at_date),
+    )
+
+
+@stage("counts")
+def get_counts(
+    death: Dict[str, Any],
+    hosp: Dict[str, Any],
+    symptoms: Dict[str, Any],
+    start_date: date,
+    end_date: date,
+    region: str = "CHFL",
+) -> CovidData:
+    """Returns the counts drawn by draw_chart, with y/height from AGE_BARS."""
+    load_resources([death, hosp, symptoms], region)
+    return CovidData(
+        pd.DataFrame(get_delta(hosp, start_date, end_date, region)).join(
+            AGE_BARS, how="inner"
+        ),
+        pd.DataFrame(get_delta(death, start_date, end_date, region)).join(
+            AGE_BARS, how="inner"
+        ),
+        pd.DataFrame(get_delta(symptoms, start_date, end_date, region)).join(
+            AGE_BARS, how="inner"
+        ),
+    )
+
+
+@stage("counts")
+def get_region_counts(
+    death: Dict[str, Any],
+    hosp: Dict[str, Any],
+    symptoms: Dict[str, Any],
+    start_date: date,
+    end_date: date,
+    regions: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Returns the counts of get_counts for many regions at once, as a frame indexed
+    by region, series and age, with columns sumTotal, y and height.
+
+    Each resource is loaded and grouped once for all the regions, which default to
+    every geoRegion of the resources. A region only has the series of the resources
+    publishing it, see region_counts.
+    """
+    indexes = _load_indexes(death, hosp, symptoms, regions)
+    return index_region_counts(indexes, start_date, end_date, regions)
+
+
+def _load_indexes(
+    death: Dict[str, Any],
+    hosp: Dict[str, Any],
+    symptoms: Dict[str, Any],
+    regions: Optional[List[str]],
+) -> CovidData:
+    """Returns the cumulative indexes of the resources, of the region when regions
+    only has one, and of all of them otherwise."""
+    region = regions[0] if regions is not None and len(set(regions)) == 1 else None
+    load_resources([death, hosp, symptoms], region)
+    return CovidData(
+        *(load_index(resource, region) for resource in (hosp, death, symptoms))
+    )
+
+
+def _unique_regions(indexes: CovidData, regions: Optional[List[str]]) -> List[str]:
+    """Returns regions without repeats, in their order, or every geoRegion of
+    indexes if None."""
+    if regions is None:
+        return sorted(set().union(*(index.regions for index in indexes)))
+    return list(dict.fromkeys(regions))
+
+
+def index_region_counts(
+    indexes: CovidData,
+    start_date: date,
+    end_date: date,
+    regions: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Returns the cube of get_region_counts from the cumulative indexes of the hosp,
+    death and symptoms resources, see series.load_index. Repeated regions are only
+    counted once."""
+    regions = _unique_regions(indexes, regions)
+    frame = index_window_counts(indexes, [(start_date, end_date)], regions)
+    cube = frame.drop(columns=["start", "end"])
+    cube["region"] = pd.Categorical(cube["region"], categories=regions)
+    return cube.set_index(["region", "series", "age"]).sort_index()
+
+
+def index_window_counts(
+    indexes: CovidData,
+    windows: Sequence[Tuple[date, date]],
+    regions: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Returns the counts of get_counts for every (start, end) window and region at
+    once, from the cumulative indexes of the hosp, death and symptoms resources, as
+    a tidy frame with columns region, start, end, series, age, sumTotal, y and
+    height. Regions default to every geoRegion, are only counted once when repeated,
+    and only have rows for the series of the resources publishing them."""
+    bounds = np.asarray(windows, dtype="datetime64[D]").reshape(-1, 2)
+    regions = _unique_regions(indexes, regions)
+    frames = []
+    for name, index in zip(CovidData._fields, indexes):
+        region_positions = index.regions.get_indexer(regions)
+        found = np.asarray(regions)[region_positions >= 0]
+        ages = index.ages[index.ages.isin(AGE_BARS.index)]
+        series = index.values[region_positions[region_positions >= 0]][
+            :, index.ages.get_indexer(ages)
+        ]
+        # counts[region, window, age]
+        counts = (
+            series[:, :, time_positions(index, bounds[:, 1])]
+            - series[:, :, time_positions(index, bounds[:, 0])]
+        ).transpose(0, 2, 1)
+        rows = len(found) * len(bounds)
+        bars = AGE_BARS.loc[ages]
+        frames.append(
+            pd.DataFrame(
+                {
+                    "region": np.repeat(found, len(bounds) * len(ages)),
+                    "start": np.tile(np.repeat(bounds[:, 0], len(ages)), len(found)),
+                    "end": np.tile(np.repeat(bounds[:, 1], len(ages)), len(found)),
+                    "series": name,
+                    "age": np.tile(ages.to_numpy(), rows),
+                    "sumTotal": counts.ravel(),
+                    "y": np.tile(bars["y"].to_numpy(), rows),
+                    "height": np.tile(bars["height"].to_numpy(), rows),
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True)
+
+
+@stage("counts")
+def get_bulk_counts(
+    death: Dict[str, Any],
+    hosp: Dict[str, Any],
+    symptoms: Dict[str, Any],
+    windows: Sequence[Tuple[date, date]],
+    regions: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Returns the counts of get_counts for every window and region, see
+    index_window_counts. Each resource is loaded and indexed once for all of
+    them."""
+    indexes = _load_indexes(death, hosp, symptoms, regions)
+    return index_window_counts(indexes, windows, regions)
+
+
+def region_counts(cube: pd.DataFrame, region: str) -> CovidData:
+    """Returns the counts of region in a get_region_counts cube, as get_counts.
+
+    Vaccine adverse effects are only published for some regions, and the symptoms
+    of the others are an empty frame. Missing hosp or death counts raise KeyError.
+    """
+    counts = {}
+    for name in CovidData._fields:
+        if (region, name) in cube.index:
+            counts[name] = cube.loc[(region, name)]
+        elif name == "symptoms":
+            counts[name] = cube.iloc[:0].droplevel(["region", "series"])
+        else:
+            raise KeyError(f"no {name} data for geoRegion {region}")
+    return CovidData(**counts)
+
+
+def rebin_counts(
+    counts: CovidData,
+    target: Sequence[str] = BAG_AGE_CLASSES,
+    weights: Optional[np.ndarray] = None,
+) -> CovidData:
+    """Maps the counts of get_counts to the same target age classes, so that the
+    three series can be compared class by class, see ages.overlap_matrix."""
+    return CovidData(*(rebin_frame(frame, target, weights) for frame in counts))
+
+
+def get_labels(
+    death: Dict[str, Any], hosp: Dict[str, Any], symptoms: Dict[str, Any]
+) -> CovidData:
+    return CovidData(
+        hosp["display_name"]["en"],
+        death["display_name"]["en"],
+        symptoms["display_name"]["en"],
+    )
+
+
+@stage("counts")
+def get_window_counts(
+    death: Dict[str, Any],
+    hosp: Dict[str, Any],
+    symptoms: Dict[str, Any],
+    windows: Sequence[Tuple[date, date]],
+    region: str = "CHFL",
+) -> pd.DataFrame:
+    """Returns the counts of get_counts for every (start, end) window, see
+    index_window_counts. Each resource is loaded once and all windows are looked up
+    at once. Resources without data for region raise KeyError."""
+    indexes = _load_indexes(death, hosp, symptoms, [region])
+    for index, resource in zip(indexes, (hosp, death, symptoms)):
+        region_position(index, resource, region)
+    return index_window_counts(indexes, windows, [region])
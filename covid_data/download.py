@@ -0,0 +1,112 @@
+"""On-disk HTTP cache for the resource downloads."""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlsplit
+
+import requests
+from lockfile import LockFile, LockTimeout
+
+from . import config
+from .metrics import stage
+
+logger = logging.getLogger(__name__)
+_HOST_SEMAPHORES: Dict[str, threading.BoundedSemaphore] = {}
+_HOST_SEMAPHORES_LOCK = threading.Lock()
+
+
+def _host_semaphore(url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc
+    with _HOST_SEMAPHORES_LOCK:
+        semaphore = _HOST_SEMAPHORES.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(config.DOWNLOADS_PER_HOST)
+            _HOST_SEMAPHORES[host] = semaphore
+    return semaphore
+
+
+@contextmanager
+def _cache_lock(base_path: str) -> Iterator[None]:
+    """Holds the lock file of the cache entry at base_path, breaking it when still
+    held after config.HTTP_LOCK_TIMEOUT seconds."""
+    lock = LockFile(base_path, timeout=config.HTTP_LOCK_TIMEOUT)
+    try:
+        lock.acquire()
+    except LockTimeout:
+        logger.warning("Breaking the stale lock %s", lock.lock_file)
+        lock.break_lock()
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def cached_download(url: str, cache_dir: Optional[str] = None) -> str:
+    """Downloads url into cache_dir and returns the path of the local copy.
+
+    A cached copy is revalidated with a conditional GET (If-None-Match /
+    If-Modified-Since) and kept as is when the server answers 304, cannot be
+    reached, or when config.OFFLINE is set. Cache entries are only read and written
+    while holding a lock file, and bodies are replaced atomically, so several
+    processes can share the same cache_dir. Locks left by killed processes are
+    broken after config.HTTP_LOCK_TIMEOUT seconds.
+    """
+    cache_dir = cache_dir or config.HTTP_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    base_path = os.path.join(cache_dir, key)
+    body_path = base_path + ".body"
+    meta_path = base_path + ".json"
+    validators: Dict[str, str] = {}
+    with _cache_lock(base_path):
+        cached = os.path.exists(body_path) and os.path.exists(meta_path)
+        if cached:
+            with open(meta_path, encoding="utf-8") as f:
+                validators = json.load(f)
+    if config.OFFLINE:
+        if not cached:
+            raise FileNotFoundError(f"No cached copy of {url}")
+        return body_path
+    headers = {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last_modified" in validators:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    tmp_path = f"{base_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with stage("download") as record, _host_semaphore(url), requests.get(
+            url, headers=headers, stream=True, timeout=config.HTTP_TIMEOUT
+        ) as response:
+            if response.status_code == 304 and validators:
+                return body_path
+            response.raise_for_status()
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(config.HTTP_CHUNK_SIZE):
+                    f.write(chunk)
+                    record.bytes += len(chunk)
+            validators = {}
+            if "ETag" in response.headers:
+                validators["etag"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                validators["last_modified"] = response.headers["Last-Modified"]
+    except BaseException as e:
+        # A partial body would otherwise stay in the shared cache directory
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        if not cached or not isinstance(e, requests.RequestException):
+            raise
+        logger.warning("Could not revalidate %s (%s), using the cached copy", url, e)
+        return body_path
+    with _cache_lock(base_path):
+        os.replace(tmp_path, body_path)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(validators, f)
+    return body_path
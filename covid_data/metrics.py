@@ -0,0 +1,222 @@
+"""Instrumentation of the pipeline stages, exported as Prometheus metrics.
+
+The stages are wrapped in stage(), which measures their duration, and lets them
+count the bytes downloaded and rows parsed. Every finished stage is passed to the
+hooks, which by default add it to the totals of its stage, in plain Python so
+that stages cost next to nothing. prometheus-client and psutil are only imported
+once the metrics are exported, see get_registry, after which stages also measure
+the resident set size of the process when they end. The peak resident set size
+is the one the kernel reports for the whole process.
+"""
+
+import bisect
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class StageRecord:
+    """Measurements of one run of a stage."""
+
+    __slots__ = ("name", "seconds", "bytes", "rows", "rss")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.seconds = 0.0
+        self.bytes = 0
+        self.rows = 0
+        self.rss: Optional[int] = None
+
+
+# Upper bounds of the buckets of the stage durations, in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class _StageTotals:
+    """Measurements of all the runs of a stage."""
+
+    __slots__ = ("buckets", "seconds", "bytes", "rows", "rss")
+
+    def __init__(self) -> None:
+        # Runs per duration bucket, the last one being above all the bounds
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+        self.seconds = 0.0
+        self.bytes = 0
+        self.rows = 0
+        self.rss: Optional[int] = None
+
+
+_TOTALS: Dict[str, _StageTotals] = {}
+_TOTALS_LOCK = threading.Lock()
+
+
+def _add_to_totals(record: StageRecord) -> None:
+    with _TOTALS_LOCK:
+        totals = _TOTALS.get(record.name)
+        if totals is None:
+            totals = _TOTALS[record.name] = _StageTotals()
+        totals.buckets[bisect.bisect_left(DURATION_BUCKETS, record.seconds)] += 1
+        totals.seconds += record.seconds
+        totals.bytes += record.bytes
+        totals.rows += record.rows
+        if record.rss is not None:
+            totals.rss = record.rss
+
+
+# Called with the StageRecord of every finished stage, from the thread that ran it
+HOOKS: List[Callable[[StageRecord], None]] = [_add_to_totals]
+
+# psutil.Process of this process once the metrics are exported, see get_registry
+_PROCESS: Any = None
+_PEAK_RSS = 0
+_PEAK_RSS_LOCK = threading.Lock()
+
+
+def _rss() -> Optional[int]:
+    global _PEAK_RSS
+    if _PROCESS is None:
+        return None
+    rss = _PROCESS.memory_info().rss
+    with _PEAK_RSS_LOCK:
+        _PEAK_RSS = max(_PEAK_RSS, rss)
+    return rss
+
+
+def peak_rss() -> Optional[int]:
+    """Returns the highest resident set size of the process so far, in bytes, also
+    when it was reached within a stage. Without getrusage, as on Windows, it is the
+    peak working set from psutil, or else the highest one seen at the end of a
+    stage."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+    if _PROCESS is None:
+        return None
+    return getattr(_PROCESS.memory_info(), "peak_wset", _PEAK_RSS)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[StageRecord]:
+    """Measures the stage run in the with block, whose code may add to the bytes and
+    rows of the yielded record, and passes the record to the hooks."""
+    record = StageRecord(name)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        record.rss = _rss()
+        for hook in HOOKS:
+            hook(record)
+
+
+class _StageCollector:
+    """Collects the metrics of the stage totals, when the registry is scraped."""
+
+    def collect(self) -> Iterator[Any]:
+        from prometheus_client.core import (
+            CounterMetricFamily,
+            GaugeMetricFamily,
+            HistogramMetricFamily,
+        )
+        from prometheus_client.utils import floatToGoString
+
+        with _TOTALS_LOCK:
+            totals = {
+                name: (list(t.buckets), t.seconds, t.bytes, t.rows, t.rss)
+                for name, t in _TOTALS.items()
+            }
+        durations = HistogramMetricFamily(
+            "covid_data_stage_duration_seconds",
+            "Duration of the pipeline stages",
+            labels=["stage"],
+        )
+        downloaded = CounterMetricFamily(
+            "covid_data_stage_bytes",
+            "Bytes downloaded by the pipeline stages",
+            labels=["stage"],
+        )
+        parsed = CounterMetricFamily(
+            "covid_data_stage_rows",
+            "Rows parsed by the pipeline stages",
+            labels=["stage"],
+        )
+        rss = GaugeMetricFamily(
+            "covid_data_stage_rss_bytes",
+            "Resident set size of the process at the end of the last run of the stage",
+            labels=["stage"],
+        )
+        for name, (buckets, seconds, byte_count, rows, last_rss) in totals.items():
+            runs = 0
+            cumulative = []
+            for bound, count in zip(DURATION_BUCKETS, buckets):
+                runs += count
+                cumulative.append((floatToGoString(bound), runs))
+            cumulative.append(("+Inf", runs + buckets[-1]))
+            durations.add_metric([name], cumulative, seconds)
+            if byte_count:
+                downloaded.add_metric([name], byte_count)
+            if rows:
+                parsed.add_metric([name], rows)
+            if last_rss is not None:
+                rss.add_metric([name], last_rss)
+        peak = GaugeMetricFamily(
+            "covid_data_peak_rss_bytes",
+            "Highest resident set size of the process",
+            value=peak_rss() or float("nan"),
+        )
+        return iter([durations, downloaded, parsed, rss, peak])
+
+
+_REGISTRY: Any = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_registry() -> Any:
+    """Returns the prometheus_client registry of the stage metrics, created on first
+    use, from then on with the resident set size of the stages when psutil is
+    installed."""
+    global _REGISTRY, _PROCESS
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            try:
+                import prometheus_client
+            except ImportError:
+                raise ImportError(
+                    "prometheus-client is needed to export the metrics"
+                ) from None
+            try:
+                import psutil
+
+                _PROCESS = psutil.Process()
+            except ImportError:
+                pass
+            registry = prometheus_client.CollectorRegistry()
+            registry.register(_StageCollector())
+            _REGISTRY = registry
+    return _REGISTRY
+
+
+def start_exporter(port: int, addr: str = "0.0.0.0") -> None:
+    """Serves the metrics over HTTP on port, from a daemon thread."""
+    registry = get_registry()
+    import prometheus_client
+
+    prometheus_client.start_http_server(port, addr, registry=registry)
+
+
+def write_textfile(path: str) -> None:
+    """Writes the metrics to path, in the format of the node exporter textfile
+    collector, replacing the file atomically."""
+    registry = get_registry()
+    import prometheus_client
+
+    prometheus_client.write_to_textfile(path, registry)
@@ -0,0 +1,98 @@
+"""Population by region and year of age, for rates per 100k inhabitants."""
+
+from collections import namedtuple
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from . import config
+from .ages import SINGLE_YEAR_AGE_CLASSES, UNKNOWN_AGES, rebin
+from .store import load_resource
+
+# Population of each region by year of age, years[region, age] for ages below
+# ages.AGE_LIMIT, the last one counting everyone older
+PopulationTable = namedtuple("PopulationTable", ["regions", "years"])
+
+# Population tables, keyed by file name or download URL
+_POPULATION_TABLES: Dict[str, PopulationTable] = {}
+
+
+def build_population_table(
+    frame: pd.DataFrame, age_column: str = "age"
+) -> PopulationTable:
+    """Returns the table of a frame with columns geoRegion, age_column and pop, ages
+    being single years or any age classes, spread uniformly over their years."""
+    known = ~frame[age_column].isin(UNKNOWN_AGES + ("all",))
+    pop = (
+        frame[known & frame["pop"].notna()]
+        .pivot_table(
+            index="geoRegion",
+            columns=age_column,
+            values="pop",
+            aggfunc="sum",
+            observed=True,
+        )
+        .fillna(0)
+    )
+    years = rebin(
+        pop.to_numpy(dtype=np.float64),
+        pop.columns.astype(str),
+        SINGLE_YEAR_AGE_CLASSES,
+    )
+    return PopulationTable(pd.Index(pop.index.astype(str)), years)
+
+
+def load_population(resource: Optional[Dict[str, Any]] = None) -> PopulationTable:
+    """Returns the table of config.POPULATION_FILE, or else of the pop column of
+    resource, a weekly age range resource, as last published."""
+    path = config.POPULATION_FILE
+    key = path or resource["download_url"]
+    table = _POPULATION_TABLES.get(key)
+    if table is None:
+        if path:
+            table = build_population_table(
+                pd.read_csv(path, dtype={"geoRegion": str, "age": str})
+            )
+        else:
+            frame = load_resource(resource, None)
+            latest = frame[frame["datum"] == frame["datum"].max()]
+            table = build_population_table(latest, "altersklasse_covid19")
+        _POPULATION_TABLES[key] = table
+    return table
+
+
+def class_population(
+    table: PopulationTable, regions: Sequence[str], age_classes: Sequence[str]
+) -> np.ndarray:
+    """Returns the population of regions in age_classes, of shape (regions, classes).
+    Classes of unknown age have no population."""
+    positions = table.regions.get_indexer(regions)
+    if (positions < 0).any():
+        missing = np.asarray(regions)[positions < 0]
+        raise KeyError(f"no population for geoRegion {', '.join(missing)}")
+    return rebin(table.years[positions], SINGLE_YEAR_AGE_CLASSES, age_classes)
+
+
+def add_rates(
+    frame: pd.DataFrame, table: PopulationTable, region: Optional[str] = None
+) -> pd.DataFrame:
+    """Returns frame with a column per100k of sumTotal per 100000 inhabitants of the
+    same region and age class. frame is indexed by age class like those of
+    get_counts, when region is given, or else by region, ..., age class like the cube
+    of get_region_counts. Unknown ages get no rate."""
+    ages = frame.index.get_level_values(-1).astype(str)
+    if region is None:
+        regions = frame.index.get_level_values(0).astype(str)
+    else:
+        regions = pd.Index([region] * len(frame))
+    region_codes, unique_regions = pd.factorize(regions)
+    age_codes, unique_ages = pd.factorize(ages)
+    pop = class_population(table, unique_regions, unique_ages)[region_codes, age_codes]
+    rates = np.divide(
+        frame["sumTotal"].to_numpy(dtype=np.float64) * 100000,
+        pop,
+        out=np.full(len(frame), np.nan),
+        where=pop > 0,
+    )
+    return frame.assign(per100k=rates)
@@ -0,0 +1,240 @@
+"""Registry of the resources of the dataset: how each one is parsed and indexed.
+
+Every resource goes through the same path, store.load_resource for its typed rows
+and series.load_index for its cumulative series. Resources missing from
+RESOURCE_SPECS get a spec inferred from the first rows of their file.
+"""
+
+from collections import namedtuple
+from typing import IO, Any, Dict, Iterable, Optional, Union
+
+import pandas as pd
+
+from . import config
+from .bundle import resource_opener
+
+# How a resource is parsed and indexed:
+# - schema: columns read, with compact types, the other ones being skipped
+# - time_column and time_unit: the column of the time keys, BAG ISO week keys
+#   (yyyyww) for "week" and YYYY-MM-DD dates for "day"
+# - dimensions: the columns the rows are keyed by besides time, geoRegion first
+# - measures: the columns of numbers
+# - fixed: values the dimensions not indexed are restricted to in the cumulative
+#   index, whose classes are those of the one dimension left besides geoRegion
+# - total: the cumulative measure of the index, or None when it has none
+ResourceSpec = namedtuple(
+    "ResourceSpec",
+    ["schema", "time_column", "time_unit", "dimensions", "measures", "fixed", "total"],
+    defaults=({}, "sumTotal"),
+)
+
+TIME_COLUMNS = ("datum", "date")
+# Columns never parsed: version changes on every publication
+IGNORED_COLUMNS = ("version",)
+
+
+def _daily_spec(
+    time_column: str, *measures: str, **dimensions: Optional[str]
+) -> ResourceSpec:
+    """Returns the spec of a daily resource by geoRegion and the given dimensions,
+    mapped to their value in the cumulative index, or to None for the classes."""
+    schema = {time_column: "category", "geoRegion": "category"}
+    schema.update({dimension: "category" for dimension in dimensions})
+    schema.update({measure: "Int64" for measure in measures})
+    fixed = {name: value for name, value in dimensions.items() if value is not None}
+    return ResourceSpec(
+        schema,
+        time_column,
+        "day",
+        ("geoRegion",) + tuple(dimensions),
+        measures,
+        fixed,
+        "sumTotal" if "sumTotal" in measures else None,
+    )
+
+
+def _weekly_spec(class_column: str, *measures: str) -> ResourceSpec:
+    """Returns the spec of a weekly resource by geoRegion and class_column."""
+    schema = {"datum": "int32", "geoRegion": "category", class_column: "category"}
+    schema.update({measure: "Int32" for measure in measures})
+    return ResourceSpec(
+        schema, "datum", "week", ("geoRegion", class_column), measures
+    )
+
+
+_WEEKLY_AGE_RANGE_SPEC = _weekly_spec(
+    "altersklasse_covid19", "entries", "sumTotal", "pop"
+)
+_WEEKLY_SEX_SPEC = _weekly_spec("sex", "entries", "sumTotal")
+
+RESOURCE_SPECS: Dict[str, ResourceSpec] = {
+    "daily-cases-csv": _daily_spec("datum", "entries", "sumTotal", "pop"),
+    "daily-hosp-csv": _daily_spec("datum", "entries", "sumTotal", "pop"),
+    "daily-death-csv": _daily_spec("datum", "entries", "sumTotal", "pop"),
+    "daily-test-csv": _daily_spec(
+        "datum", "entries", "entries_pos", "entries_neg", "sumTotal", "pop"
+    ),
+    "daily-hosp-capacity-csv": ResourceSpec(
+        {
+            "date": "category",
+            "geoRegion": "category",
+            "type_variant": "category",
+            "ICU_AllPatients": "Int32",
+            "ICU_Covid19Patients": "Int32",
+            "ICU_Capacity": "Int32",
+            "Total_AllPatients": "Int32",
+            "Total_Covid19Patients": "Int32",
+            "Total_Capacity": "Int32",
+        },
+        "date",
+        "day",
+        ("geoRegion", "type_variant"),
+        (
+            "ICU_AllPatients",
+            "ICU_Covid19Patients",
+            "ICU_Capacity",
+            "Total_AllPatients",
+            "Total_Covid19Patients",
+            "Total_Capacity",
+        ),
+        # Occupancy is not cumulative, so there is no index
+        total=None,
+    ),
+    "daily-vacc-doses-administered-csv": _daily_spec(
+        "date", "entries", "sumTotal", "pop", type=None
+    ),
+    "weekly-cases-age-range-csv": _WEEKLY_AGE_RANGE_SPEC,
+    "weekly-hosp-age-range-csv": _WEEKLY_AGE_RANGE_SPEC,
+    "weekly-death-age-range-csv": _WEEKLY_AGE_RANGE_SPEC,
+    "weekly-test-age-range-csv": _WEEKLY_AGE_RANGE_SPEC,
+    "weekly-cases-sex-csv": _WEEKLY_SEX_SPEC,
+    "weekly-hosp-sex-csv": _WEEKLY_SEX_SPEC,
+    "weekly-death-sex-csv": _WEEKLY_SEX_SPEC,
+    "weekly-vacc-persons-age-range-csv": ResourceSpec(
+        {
+            "date": "int32",
+            "geoRegion": "category",
+            "altersklasse_covid19": "category",
+            "type": "category",
+            "entries": "Int32",
+            "sumTotal": "Int32",
+            "pop": "Int32",
+        },
+        "date",
+        "week",
+        ("geoRegion", "altersklasse_covid19", "type"),
+        ("entries", "sumTotal", "pop"),
+        {"type": "COVID19FullyVaccPersons"},
+    ),
+    "daily-vacc-symptoms-csv": ResourceSpec(
+        {
+            "date": "category",
+            "geoRegion": "category",
+            "vaccine": "category",
+            "age_group": "category",
+            "severity": "category",
+            "sumTotal": "Int32",
+        },
+        "date",
+        "day",
+        ("geoRegion", "vaccine", "age_group", "severity"),
+        ("sumTotal",),
+        {"vaccine": "all", "severity": "all"},
+    ),
+}
+
+# Specs inferred for the resources missing from RESOURCE_SPECS, keyed by download
+# URL
+_INFERRED_SPECS: Dict[str, ResourceSpec] = {}
+
+
+def infer_spec(
+    path: Union[str, IO[bytes]], rows: Optional[int] = None
+) -> ResourceSpec:
+    """Returns the spec of the CSV file at path, a path or a binary file object,
+    from its first rows, by default
+    config.SPEC_SAMPLE_ROWS of them.
+
+    Numbers are measures, whole ones being typed as Int64 and the others as
+    float64, and other columns are dimensions. The time unit is week for whole
+    numbers and day otherwise. The cumulative index, if any, is of sumTotal.
+    """
+    sample = pd.read_csv(path, nrows=rows or config.SPEC_SAMPLE_ROWS)
+    time_column = next((c for c in TIME_COLUMNS if c in sample.columns), None)
+    if time_column is None:
+        raise ValueError(f"The file has none of the time columns {TIME_COLUMNS}")
+    time_unit = (
+        "week" if pd.api.types.is_integer_dtype(sample[time_column]) else "day"
+    )
+    schema = {time_column: "int32" if time_unit == "week" else "category"}
+    dimensions = []
+    measures = []
+    for column in sample.columns:
+        values = sample[column]
+        if column == time_column or column in IGNORED_COLUMNS:
+            continue
+        if pd.api.types.is_bool_dtype(values):
+            schema[column] = "boolean"
+        elif pd.api.types.is_numeric_dtype(values):
+            whole = values.dropna().mod(1).eq(0).all()
+            schema[column] = "Int64" if whole else "float64"
+            measures.append(column)
+        else:
+            schema[column] = "category"
+            dimensions.append(column)
+    if "geoRegion" in dimensions:
+        dimensions.remove("geoRegion")
+        dimensions.insert(0, "geoRegion")
+    return ResourceSpec(
+        schema,
+        time_column,
+        time_unit,
+        tuple(dimensions),
+        tuple(measures),
+        total="sumTotal" if "sumTotal" in measures else None,
+    )
+
+
+def resource_spec(resource: Dict[str, Any]) -> ResourceSpec:
+    """Returns the spec of resource, registered in RESOURCE_SPECS or else inferred
+    from its file, which is then downloaded."""
+    spec = RESOURCE_SPECS.get(resource["identifier"])
+    if spec is not None:
+        return spec
+    url = resource["download_url"]
+    spec = _INFERRED_SPECS.get(url)
+    if spec is None:
+        with resource_opener(resource)() as f:
+            spec = infer_spec(f)
+        _INFERRED_SPECS[url] = spec
+    return spec
+
+
+def check_columns(resource: Dict[str, Any], columns: Iterable[str]) -> None:
+    """Raises ValueError when columns, those of the file of resource, miss some of
+    the time, dimension or measure columns of its spec."""
+    spec = resource_spec(resource)
+    columns = set(columns)
+    needed = (spec.time_column, *spec.dimensions, *spec.measures)
+    missing = [column for column in needed if column not in columns]
+    if missing:
+        raise ValueError(
+            f"{resource['identifier']} has no column {', '.join(missing)}, its spec "
+            "does not match its file"
+        )
+
+
+def class_column(spec: ResourceSpec) -> Optional[str]:
+    """Returns the dimension the cumulative index of spec has classes of, or None
+    when it only has one class, all."""
+    columns = [
+        column
+        for column in spec.dimensions
+        if column != "geoRegion" and column not in spec.fixed
+    ]
+    if len(columns) > 1:
+        raise ValueError(
+            f"Cannot index by {', '.join(columns)} at once, restrict all but one of "
+            "them with fixed"
+        )
+    return columns[0] if columns else None
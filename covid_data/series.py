@@ -0,0 +1,180 @@
+"""Dense cumulative series of the resources, for constant time date differences."""
+
+from collections import namedtuple
+from datetime import date
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .metrics import stage
+from .resources import class_column, resource_spec
+from .store import evict_resource, load_resource
+
+# Cumulative totals of a resource, values[region, age, time], where time 0 is before
+# the first published date and times holds the sorted time keys of the other ones.
+# ages holds the classes of the indexed dimension, age classes for the resources
+# compared by the chart, or only "all" when there is none, see
+# resources.class_column.
+CumulativeIndex = namedtuple(
+    "CumulativeIndex", ["regions", "ages", "times", "values", "time_unit"]
+)
+
+# Days covered by the ISO week key table
+CALENDAR_START = np.datetime64("2000-01-01")
+CALENDAR_END = np.datetime64("2100-01-01")
+# Cumulative indexes, keyed by download URL and region (None for all the regions)
+_CUMULATIVE_INDEXES: Dict[Tuple[str, Optional[str]], CumulativeIndex] = {}
+
+
+def build_cumulative_index(
+    frame: pd.DataFrame,
+    time_column: str,
+    time_unit: str,
+    age_column: Optional[str],
+    fixed: Dict[str, str],
+    total: str = "sumTotal",
+) -> CumulativeIndex:
+    if age_column is None:
+        age_column = "class"
+        frame = frame.assign(**{age_column: "all"})
+        mask = pd.Series(True, index=frame.index)
+    else:
+        mask = frame[age_column] != "all"
+    for column, value in fixed.items():
+        mask &= frame[column] == value
+    sums = (
+        frame[mask]
+        .groupby(["geoRegion", age_column, time_column], observed=True)[total]
+        .sum()
+    )
+    sums.index = sums.index.remove_unused_levels()
+    regions, ages, times = sums.index.levels
+    region_codes, age_codes, time_codes = sums.index.codes
+    times = np.asarray(times)
+    if time_unit == "day":
+        times = times.astype("datetime64[D]")
+    order = np.argsort(times, kind="stable")
+    time_rank = np.empty_like(order)
+    time_rank[order] = np.arange(len(order))
+    shape = (len(regions), len(ages), len(times) + 1)
+    values = np.zeros(shape, dtype=np.int64)
+    published = np.zeros(shape, dtype=bool)
+    published[:, :, 0] = True
+    values[region_codes, age_codes, time_rank[time_codes] + 1] = sums.to_numpy(
+        dtype=np.int64
+    )
+    published[region_codes, age_codes, time_rank[time_codes] + 1] = True
+    # Carry each total forward over the dates where it was not published
+    last = np.where(published, np.arange(shape[2]), 0)
+    np.maximum.accumulate(last, axis=2, out=last)
+    values = np.take_along_axis(values, last, axis=2)
+    return CumulativeIndex(
+        pd.Index(regions.astype(str)),
+        pd.Index(ages.astype(str)),
+        times[order],
+        values,
+        time_unit,
+    )
+
+
+def load_index(
+    resource: Dict[str, Any], region: Optional[str] = "CHFL"
+) -> CumulativeIndex:
+    """Returns the cumulative index of resource for region, or for all the regions
+    if None. An index of all the regions, when loaded, also serves single regions."""
+    key = (resource["download_url"], region)
+    index = _CUMULATIVE_INDEXES.get(key)
+    if index is None:
+        index = _CUMULATIVE_INDEXES.get((resource["download_url"], None))
+    if index is None:
+        spec = resource_spec(resource)
+        if spec.total is None:
+            raise ValueError(f"{resource['identifier']} has no cumulative measure")
+        frame = load_resource(resource, region)
+        with stage("index"):
+            index = build_cumulative_index(
+                frame,
+                spec.time_column,
+                spec.time_unit,
+                class_column(spec),
+                spec.fixed,
+                spec.total,
+            )
+        _CUMULATIVE_INDEXES[key] = index
+    return index
+
+
+def evict_index(resource: Dict[str, Any]) -> None:
+    """Drops the cumulative indexes and frames of resource kept in memory, so that
+    the next load reads its current version."""
+    url = resource["download_url"]
+    for key in [key for key in _CUMULATIVE_INDEXES if key[0] == url]:
+        _CUMULATIVE_INDEXES.pop(key, None)
+    evict_resource(resource)
+
+
+@lru_cache(maxsize=None)
+def _week_key_table() -> np.ndarray:
+    days = pd.date_range(CALENDAR_START, CALENDAR_END, inclusive="left")
+    iso_calendar = days.isocalendar()
+    return (iso_calendar["year"] * 100 + iso_calendar["week"]).to_numpy(dtype=np.int32)
+
+
+def week_keys(dates: Union[date, np.ndarray, List[date]]) -> np.ndarray:
+    """Maps dates to BAG ISO week keys (yyyyww, e.g. 202105 for 2021 week 5).
+
+    Accepts a single date or any array-like of dates, and looks the keys up in a
+    precomputed calendar table, so that no string is built. Dates outside the
+    table, from CALENDAR_START to CALENDAR_END, get its first or last key, which
+    come before or after every published week.
+    """
+    days = np.asarray(dates, dtype="datetime64[D]")
+    table = _week_key_table()
+    positions = (days - CALENDAR_START).astype(np.int64)
+    return table[np.clip(positions, 0, len(table) - 1)]
+
+
+def _time_keys(
+    index: CumulativeIndex, dates: Union[date, np.ndarray, List[date]]
+) -> np.ndarray:
+    if index.time_unit == "day":
+        return np.asarray(dates, dtype="datetime64[D]")
+    return week_keys(dates)
+
+
+def time_positions(
+    index: CumulativeIndex, dates: Union[date, np.ndarray, List[date]]
+) -> np.ndarray:
+    """Maps dates to positions along the time axis of index.values."""
+    return np.searchsorted(index.times, _time_keys(index, dates), side="right")
+
+
+def region_position(
+    index: CumulativeIndex, resource: Dict[str, Any], region: str
+) -> int:
+    """Returns the position of region along the region axis of index.values."""
+    if region not in index.regions:
+        raise KeyError(f"{resource['identifier']} has no data for geoRegion {region}")
+    return index.regions.get_loc(region)
+
+
+def get_total(
+    resource: Dict[str, Any], at_date: date, region: str = "CHFL"
+) -> pd.Series:
+    """Returns the cumulative total per age class last published at at_date."""
+    index = load_index(resource, region)
+    position = int(time_positions(index, at_date))
+    values = index.values[region_position(index, resource, region), :, position]
+    return pd.Series(values, index=index.ages, name="sumTotal")
+
+
+def get_delta(
+    resource: Dict[str, Any], start_date: date, end_date: date, region: str = "CHFL"
+) -> pd.Series:
+    """Returns the count per age class between start_date and end_date."""
+    index = load_index(resource, region)
+    series = index.values[region_position(index, resource, region)]
+    start, end = time_positions(index, [start_date, end_date])
+    return pd.Series(series[:, end] - series[:, start], index=index.ages, name="sumTotal")
@@ -0,0 +1,359 @@
+"""HTTP service rendering the chart and its counts from data kept in memory, run as
+covid-data serve.
+
+The cumulative indexes of the three resources are loaded once and kept in memory,
+so that a request only looks two dates up in them. They are refreshed in the
+background every config.SERVICE_REFRESH seconds, and swapped in once the new ones
+are ready, so requests never wait for a refresh. Responses carry an ETag made of
+the data version, which changes with the upstream modification times of the
+resources, so clients can revalidate them without the chart being drawn again.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+import tornado.ioloop
+import tornado.web
+
+from . import config
+from .chart import ChartRenderer, cached_render
+from .ckan import get_resource_map
+from .cli import RESOURCE_IDS
+from .counts import (
+    CovidData,
+    get_labels,
+    index_region_counts,
+    index_window_counts,
+    region_counts,
+)
+from .series import evict_index, load_index
+from .store import load_resources, resource_version
+
+logger = logging.getLogger(__name__)
+
+# Data a request is served from: resources in the argument order of get_counts,
+# their labels and cumulative indexes (CovidData of CumulativeIndex, for all the
+# regions), and the version they were published as
+DataSnapshot = namedtuple(
+    "DataSnapshot", ["version", "resources", "labels", "indexes"]
+)
+
+CONTENT_TYPES = {"png": "image/png", "svg": "image/svg+xml", "pdf": "application/pdf"}
+DATA_CONTENT_TYPES = {"json": "application/json", "csv": "text/csv; charset=utf-8"}
+
+
+def data_version(resources: List[Dict[str, Any]]) -> str:
+    """Returns a digest of the store versions of resources."""
+    versions = "\n".join(resource_version(resource) for resource in resources)
+    return hashlib.sha256(versions.encode("utf-8")).hexdigest()[:16]
+
+
+def load_snapshot(resources: List[Dict[str, Any]]) -> DataSnapshot:
+    """Loads the cumulative indexes of resources, death, hosp and symptoms, for all
+    the regions. Only the indexes are kept, the frames they are built from are
+    dropped from memory."""
+    death, hosp, symptoms = resources
+    try:
+        load_resources(resources, None)
+        indexes = CovidData(
+            *(load_index(resource, None) for resource in (hosp, death, symptoms))
+        )
+    finally:
+        for resource in resources:
+            evict_index(resource)
+    return DataSnapshot(
+        data_version(resources), resources, get_labels(*resources), indexes
+    )
+
+
+class ChartService:
+    """Holds the current DataSnapshot and refreshes it in the background.
+
+    Charts are rendered on a single thread, with the renderer it owns, and kept in
+    the chart cache of cached_render. Counts are computed on another one, so that
+    neither blocks the IOLoop.
+    """
+
+    def __init__(self) -> None:
+        self.snapshot: Optional[DataSnapshot] = None
+        self._refresh_lock = threading.Lock()
+        self._refresh_executor = ThreadPoolExecutor(max_workers=1)
+        self._render_executor = ThreadPoolExecutor(max_workers=1)
+        self._counts_executor = ThreadPoolExecutor(max_workers=1)
+        self._renderer: Optional[ChartRenderer] = None
+
+    def refresh(self) -> bool:
+        """Loads the resources again when they were republished, and returns
+        whether the snapshot changed. Blocks until done, and does nothing when a
+        refresh is already running."""
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            resource_map = get_resource_map()
+            resources = [resource_map[identifier] for identifier in RESOURCE_IDS]
+            if self.snapshot is not None and data_version(resources) == (
+                self.snapshot.version
+            ):
+                return False
+            self.snapshot = load_snapshot(resources)
+            logger.info("Serving data version %s", self.snapshot.version)
+            return True
+        finally:
+            self._refresh_lock.release()
+
+    async def refresh_in_background(self) -> None:
+        try:
+            await tornado.ioloop.IOLoop.current().run_in_executor(
+                self._refresh_executor, self.refresh
+            )
+        except Exception:
+            logger.exception("Refresh failed, still serving the previous data")
+
+    def _render(
+        self,
+        counts: CovidData,
+        labels: CovidData,
+        start_date: date,
+        end_date: date,
+        format: str,
+        region: str,
+    ) -> bytes:
+        if self._renderer is None:
+            self._renderer = ChartRenderer()
+        return cached_render(
+            self._renderer, counts, labels, start_date, end_date, format, region
+        )
+
+    async def render(
+        self,
+        counts: CovidData,
+        labels: CovidData,
+        start_date: date,
+        end_date: date,
+        format: str,
+        region: str,
+    ) -> bytes:
+        return await tornado.ioloop.IOLoop.current().run_in_executor(
+            self._render_executor,
+            self._render,
+            counts,
+            labels,
+            start_date,
+            end_date,
+            format,
+            region,
+        )
+
+    def _counts(
+        self,
+        indexes: CovidData,
+        windows: List[Tuple[date, date]],
+        regions: Optional[List[str]],
+        format: str,
+    ) -> bytes:
+        return encode_counts(index_window_counts(indexes, windows, regions), format)
+
+    async def counts(
+        self,
+        indexes: CovidData,
+        windows: List[Tuple[date, date]],
+        regions: Optional[List[str]],
+        format: str,
+    ) -> bytes:
+        """Returns the counts of index_window_counts, encoded by encode_counts."""
+        return await tornado.ioloop.IOLoop.current().run_in_executor(
+            self._counts_executor, self._counts, indexes, windows, regions, format
+        )
+
+
+class ServiceHandler(tornado.web.RequestHandler):
+    def initialize(self, service: ChartService) -> None:
+        self.service = service
+
+    def compute_etag(self) -> Optional[str]:
+        # ETags are set from the data version, before anything is computed
+        return None
+
+    def _date_argument(self, name: str, default: date) -> date:
+        value = self.get_argument(name, None)
+        if not value:
+            return default
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, f"{name} is not a YYYY-MM-DD date")
+
+    def _check_window(self, start_date: date, end_date: date) -> None:
+        if start_date > end_date:
+            raise tornado.web.HTTPError(
+                400, f"start {start_date} is after end {end_date}"
+            )
+
+    def _snapshot(self) -> DataSnapshot:
+        snapshot = self.service.snapshot
+        if snapshot is None:
+            raise tornado.web.HTTPError(503, "data not loaded yet")
+        return snapshot
+
+    def _not_modified(self, snapshot: DataSnapshot) -> bool:
+        """Sets the ETag of the data version, and answers 304 when the client has
+        it already."""
+        self.set_header("Etag", f'"{snapshot.version}"')
+        self.set_header("Cache-Control", "no-cache")
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+
+class ChartHandler(ServiceHandler):
+    """GET /chart?start=&end=&region=&format= returns the chart of region, CHFL by
+    default, between start and end, config.START_DATE and END_DATE by default, as
+    png, svg or pdf."""
+
+    async def get(self) -> None:
+        start_date = self._date_argument("start", config.START_DATE)
+        end_date = self._date_argument("end", config.END_DATE)
+        region = self.get_argument("region", "CHFL")
+        format = self.get_argument("format", "png")
+        if format not in CONTENT_TYPES:
+            raise tornado.web.HTTPError(400, f"unknown format {format}")
+        self._check_window(start_date, end_date)
+        snapshot = self._snapshot()
+        # Unknown regions are answered 404 even to the clients with the ETag
+        cube = index_region_counts(snapshot.indexes, start_date, end_date, [region])
+        try:
+            counts = region_counts(cube, region)
+        except KeyError as e:
+            raise tornado.web.HTTPError(404, e.args[0])
+        if self._not_modified(snapshot):
+            return
+        data = await self.service.render(
+            counts, snapshot.labels, start_date, end_date, format, region
+        )
+        self.set_header("Content-Type", CONTENT_TYPES[format])
+        self.finish(data)
+
+
+def encode_counts(frame: pd.DataFrame, format: str = "json") -> bytes:
+    """Returns the counts of index_window_counts as CSV, or as compact JSON: an
+    object with the list of columns and the list of rows."""
+    frame = frame.assign(
+        start=frame["start"].dt.strftime("%Y-%m-%d"),
+        end=frame["end"].dt.strftime("%Y-%m-%d"),
+    )
+    if format == "csv":
+        return frame.to_csv(index=False).encode("utf-8")
+    return frame.to_json(orient="split", index=False).encode("utf-8")
+
+
+class CountsHandler(ServiceHandler):
+    """Returns the counts behind the chart, see index_window_counts, as json or csv.
+
+    GET /counts?start=&end=&region=&format= takes repeated start and end pairs, for
+    as many windows, and repeated regions, all standing for every geoRegion. POST
+    /counts takes the same query as a JSON object {"windows": [[start, end], ...],
+    "regions": [...] or "all", "format": ...}. Windows default to
+    config.START_DATE - END_DATE, regions to CHFL and format to json. Queries of
+    more than config.SERVICE_MAX_COUNTS windows times regions are rejected.
+    """
+
+    def _query(
+        self, windows: Sequence[Sequence[str]], regions: Sequence[str], format: str
+    ) -> Tuple[List[Tuple[date, date]], Optional[List[str]], str]:
+        if format not in DATA_CONTENT_TYPES:
+            raise tornado.web.HTTPError(400, f"unknown format {format}")
+        try:
+            dates = [
+                (date.fromisoformat(start), date.fromisoformat(end))
+                for start, end in windows
+            ]
+        except (TypeError, ValueError):
+            raise tornado.web.HTTPError(400, "windows are not YYYY-MM-DD date pairs")
+        for start_date, end_date in dates:
+            self._check_window(start_date, end_date)
+        dates = dates or [(config.START_DATE, config.END_DATE)]
+        regions = list(regions) or ["CHFL"]
+        return dates, None if "all" in regions else regions, format
+
+    async def _respond(
+        self,
+        windows: List[Tuple[date, date]],
+        regions: Optional[List[str]],
+        format: str,
+    ) -> None:
+        snapshot = self._snapshot()
+        if regions is None:
+            region_count = len(
+                set().union(*(index.regions for index in snapshot.indexes))
+            )
+        else:
+            region_count = len(regions)
+        if len(windows) * region_count > config.SERVICE_MAX_COUNTS:
+            raise tornado.web.HTTPError(
+                400,
+                f"{len(windows)} windows of {region_count} regions are more than "
+                f"the {config.SERVICE_MAX_COUNTS} counts a query may have",
+            )
+        if self.request.method == "GET" and self._not_modified(snapshot):
+            return
+        data = await self.service.counts(snapshot.indexes, windows, regions, format)
+        self.set_header("Content-Type", DATA_CONTENT_TYPES[format])
+        self.finish(data)
+
+    async def get(self) -> None:
+        starts = self.get_arguments("start")
+        ends = self.get_arguments("end")
+        if len(starts) != len(ends):
+            raise tornado.web.HTTPError(400, "as many start as end dates are needed")
+        await self._respond(
+            *self._query(
+                list(zip(starts, ends)),
+                self.get_arguments("region"),
+                self.get_argument("format", "json"),
+            )
+        )
+
+    async def post(self) -> None:
+        try:
+            query = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "the body is not JSON")
+        if not isinstance(query, dict):
+            raise tornado.web.HTTPError(400, "the body is not a JSON object")
+        regions = query.get("regions", [])
+        if isinstance(regions, str):
+            regions = [regions]
+        await self._respond(
+            *self._query(
+                query.get("windows", []), regions, query.get("format", "json")
+            )
+        )
+
+
+def make_app(service: ChartService) -> tornado.web.Application:
+    return tornado.web.Application(
+        [
+            (r"/chart", ChartHandler, {"service": service}),
+            (r"/counts", CountsHandler, {"service": service}),
+        ]
+    )
+
+
+def serve(port: int, address: str = "") -> None:
+    """Loads the data, then serves it on port until interrupted."""
+    service = ChartService()
+    service.refresh()
+    make_app(service).listen(port, address)
+    tornado.ioloop.PeriodicCallback(
+        service.refresh_in_background, config.SERVICE_REFRESH * 1000
+    ).start()
+    logger.info("Serving charts on port %d", port)
+    tornado.ioloop.IOLoop.current().start()
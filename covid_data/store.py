@@ -0,0 +1,442 @@
+"""Typed parsing of the resources and their local Parquet store."""
+
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from . import config
+from .bundle import resource_opener
+from .metrics import stage
+from .resources import check_columns, resource_spec
+
+# Loaded resources, keyed by download URL and region (None for all the regions), so
+# that each resource is only read once per process, whatever the number of dates
+# looked up in it.
+_RESOURCE_FRAMES: Dict[Tuple[str, Optional[str]], pd.DataFrame] = {}
+# Block keys and file names of a stored version, see ingest_resource
+_BLOCKS_FILE = "_blocks.json"
+
+
+def _filter_mask(chunk: pd.DataFrame, filters: Dict[str, Any]) -> pd.Series:
+    mask = pd.Series(True, index=chunk.index)
+    for column, value in filters.items():
+        if callable(value):
+            mask &= value(chunk[column])
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            mask &= chunk[column].isin(value)
+        else:
+            mask &= chunk[column] == value
+    return mask
+
+
+def iter_resource(
+    resource: Dict[str, Any],
+    filters: Optional[Dict[str, Any]] = None,
+    chunk_rows: Optional[int] = None,
+) -> Iterator[pd.DataFrame]:
+    """Parses resource chunk_rows rows at a time and yields the rows matching
+    filters, so that at most one chunk of the file is in memory.
+
+    filters maps columns to a value, a collection of values, or a function of the
+    column returning a boolean mask, e.g. {"geoRegion": ["ZH", "BE"],
+    "datum": lambda datum: datum >= 202101}.
+    """
+    with resource_opener(resource)() as f:
+        for number, chunk in enumerate(
+            _read_chunks(f, resource_spec(resource).schema, filters, chunk_rows)
+        ):
+            if number == 0:
+                check_columns(resource, chunk.columns)
+            yield chunk
+
+
+def _read_chunks(
+    f: IO[bytes],
+    schema: Dict[str, str],
+    filters: Optional[Dict[str, Any]] = None,
+    chunk_rows: Optional[int] = None,
+) -> Iterator[pd.DataFrame]:
+    """Parses the CSV file read from f chunk_rows rows at a time, see
+    iter_resource."""
+    with pd.read_csv(
+        f, chunksize=chunk_rows or config.CSV_CHUNK_ROWS, **_read_options(schema)
+    ) as reader:
+        for chunk in reader:
+            yield chunk[_filter_mask(chunk, filters)] if filters else chunk
+
+
+def _read_options(schema: Dict[str, str]) -> Dict[str, Any]:
+    # Columns of the schema missing from a file are left out rather than failing
+    # the parser, see resources.check_columns for those that are needed
+    return {"usecols": lambda column: column in schema, "dtype": schema}
+
+
+def parse_resource(
+    resource: Dict[str, Any], filters: Optional[Dict[str, Any]] = None
+) -> pd.DataFrame:
+    """Returns the rows of resource matching filters, see iter_resource."""
+    with stage("parse") as record:
+        frame = pd.concat(iter_resource(resource, filters), ignore_index=True)
+        record.rows = len(frame)
+    # Each chunk has its own categories, which concat turns into objects
+    schema = resource_spec(resource).schema
+    return frame.astype({c: t for c, t in schema.items() if c in frame.columns})
+
+
+def resource_modified(resource: Dict[str, Any]) -> str:
+    """Returns the upstream modification time of resource, or of its metadata."""
+    return (
+        resource.get("modified")
+        or resource.get("last_modified")
+        or resource["metadata_modified"]
+    )
+
+
+def version_key(*parts: str) -> str:
+    """Returns parts joined by dashes, as a file name."""
+    return re.sub(r"[^0-9A-Za-z_.-]", "_", "-".join(parts))
+
+
+def resource_version(resource: Dict[str, Any]) -> str:
+    """Returns the version of resource in the store, which changes when it is
+    republished or parsed differently."""
+    # The schema is part of the version, so that stored data gets the new columns
+    schema = repr(resource_spec(resource).schema).encode("utf-8")
+    schema_key = hashlib.sha256(schema).hexdigest()[:8]
+    return version_key(resource_modified(resource), schema_key)
+
+
+# Masks of the n first bytes of a little endian 64 bit word, for n from 0 to 8
+_BYTE_MASKS = np.array(
+    [(1 << (8 * n)) - 1 for n in range(8)] + [(1 << 64) - 1], dtype=np.uint64
+)
+
+
+def _cut_hashes(
+    data: np.ndarray, starts: np.ndarray, key_ends: np.ndarray
+) -> np.ndarray:
+    """Returns a hash of the first and last 16 bytes of the parsed columns of each
+    line data[starts:key_ends]."""
+    padded = np.concatenate([np.zeros(16, np.uint8), data, np.zeros(16, np.uint8)])
+    # Unaligned view of the 8 bytes from each offset of padded
+    words = np.ndarray((len(padded) - 7,), np.uint64, padded.data, strides=(1,))
+    hashes = np.zeros(len(starts), dtype=np.uint64)
+    for offsets in (starts, starts + 8, key_ends - 16, key_ends - 8):
+        word = words[offsets + 16]
+        word &= _BYTE_MASKS[np.clip(key_ends - offsets, 0, 8)]
+        word &= ~_BYTE_MASKS[np.clip(starts - offsets, 0, 8)]
+        hashes = (hashes ^ word) * np.uint64(0x100000001B3)
+    # splitmix64 finalizer, so that all the bits depend on all the words
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xBF58476D1CE4E5B9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94D049BB133111EB)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+def _split_blocks(f: IO[bytes], key_columns: int) -> Iterator[Tuple[int, int, str]]:
+    """Splits the CSV file read from f into blocks of lines, and yields their start
+    and end offsets and digests, the header line excluded.
+
+    Blocks end after the lines whose first and last bytes hash to a multiple of
+    config.STORE_BLOCK_LINES, and have at least a quarter of that many lines, so
+    that inserting or changing lines only changes the blocks around them. Blocks
+    are cut after at most four times that many lines all the same, which bounds
+    the memory of their parsing whatever the lines. Digests
+    only cover the key_columns first columns of the lines, those that are parsed,
+    so that columns updated on every publication, like version, do not change all
+    the blocks. Files with quotes are hashed whole, as their commas may be quoted.
+    """
+    block_lines = config.STORE_BLOCK_LINES
+    header = f.readline()
+    block_start = offset = f.tell()
+    digest = hashlib.sha1(header)
+    lines = 0
+    rest = b""
+    while True:
+        data = f.read(config.STORE_SCAN_BYTES)
+        piece = rest + data
+        if not piece:
+            break
+        cut = len(piece) if not data else piece.rfind(b"\n") + 1
+        if cut == 0:
+            rest = piece
+            continue
+        piece, rest = piece[:cut], piece[cut:]
+        array = np.frombuffer(piece, dtype=np.uint8)
+        ends = np.flatnonzero(array == ord("\n"))
+        if array[-1] != ord("\n"):
+            ends = np.append(ends, len(array))
+        starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+        key_ends = ends
+        if b'"' not in piece:
+            commas = np.flatnonzero(array == ord(","))
+            nth = np.searchsorted(commas, starts) + key_columns - 1
+            found = nth < len(commas)
+            nth_comma = commas[np.where(found, nth, 0)] if len(commas) else ends
+            key_ends = np.where(found & (nth_comma < ends), nth_comma, ends)
+        # Bytes of the parsed columns and line ends, and how many bytes are left
+        # out before each line
+        marks = np.zeros(len(array) + 1, dtype=np.int8)
+        marks[key_ends] += 1
+        marks[ends] -= 1
+        kept = array[np.cumsum(marks[:-1], dtype=np.int8) == 0]
+        left_out = np.concatenate([[0], np.cumsum(ends - key_ends)])
+        cuts = np.flatnonzero(
+            _cut_hashes(array, starts, key_ends) % np.uint64(block_lines) == 0
+        )
+        first = 0
+        for last in _block_ends(cuts, len(starts), lines, block_lines):
+            end = min(int(ends[last]) + 1, len(array))
+            digest.update(
+                kept[starts[first] - left_out[first] : end - left_out[last + 1]]
+            )
+            yield block_start, offset + end, digest.hexdigest()
+            block_start = offset + end
+            digest = hashlib.sha1(header)
+            lines = 0
+            first = last + 1
+        if first < len(starts):
+            digest.update(kept[starts[first] - left_out[first] :])
+            lines += len(starts) - first
+        offset += len(piece)
+    if offset > block_start:
+        yield block_start, offset, digest.hexdigest()
+
+
+def _block_ends(
+    cuts: np.ndarray, line_count: int, lines: int, block_lines: int
+) -> List[int]:
+    """Returns the lines of a piece of line_count lines that end a block, from the
+    positions of the lines hashing to a cut, the block being cut before the piece
+    having lines lines already. Blocks left open have less than 4 * block_lines
+    lines."""
+    max_lines = 4 * block_lines
+    ends = []
+    # Position of the first line of the open block, before the piece if negative
+    first = -lines
+    for last in cuts:
+        while last + 1 - first > max_lines:
+            first += max_lines
+            ends.append(first - 1)
+        if last + 1 - first >= block_lines // 4:
+            ends.append(int(last))
+            first = last + 1
+    while line_count - first >= max_lines:
+        first += max_lines
+        ends.append(first - 1)
+    return ends
+
+
+def ingest_resource(resource: Dict[str, Any], store_dir: Optional[str] = None) -> str:
+    """Converts resource into a Parquet dataset partitioned by geoRegion and returns
+    its directory.
+
+    Datasets are stored under the resource identifier and its upstream modification
+    time, so the CSV is only parsed again when the resource is republished. Even
+    then, only its new or revised rows are: the CSV is split into blocks of lines,
+    see _split_blocks, parsed config.CSV_CHUNK_ROWS rows at a time as iter_resource
+    does and stored as files of the block in each partition, and the files of the
+    blocks already in the previous version are linked into the new one, or parsed
+    again when another process removed them meanwhile. Older versions are
+    removed once the new one is in place, and so are the temporary directories of
+    the ingests that did not finish, after config.STORE_TMP_MAX_AGE.
+    """
+    resource_dir = os.path.join(store_dir or config.STORE_DIR, resource["identifier"])
+    version = resource_version(resource)
+    path = os.path.join(resource_dir, version)
+    if os.path.isdir(path):
+        return path
+    previous = _previous_blocks(resource_dir, version.rsplit("-", 1)[1])
+    open_csv = resource_opener(resource)
+    schema = resource_spec(resource).schema
+    with open_csv() as f:
+        header = f.readline()
+    columns = header.decode("utf-8").strip().split(",")
+    check_columns(resource, columns)
+    key_columns = max(
+        (i + 1 for i, column in enumerate(columns) if column in schema),
+        default=len(columns),
+    )
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(tmp_path)
+    blocks: List[Tuple[str, List[str]]] = []
+    occurrences: Dict[str, int] = {}
+    # Blocks are scanned and parsed from two readers of the file, moving forward
+    # only, as bundle members cannot seek back
+    with stage("parse") as record, open_csv() as scan, open_csv() as f:
+        for start, end, digest in _split_blocks(scan, key_columns):
+            occurrences[digest] = occurrences.get(digest, -1) + 1
+            key = f"{digest[:24]}-{occurrences[digest]}"
+            if key in previous and _link_block(*previous[key], tmp_path):
+                blocks.append((key, previous[key][1]))
+                continue
+            f.seek(start)
+            data = io.BytesIO(header + f.read(end - start))
+            files = []
+            for number, chunk in enumerate(_read_chunks(data, schema)):
+                record.rows += len(chunk)
+                files += _write_block(chunk, tmp_path, f"{key}-{number}")
+            blocks.append((key, files))
+    with open(os.path.join(tmp_path, _BLOCKS_FILE), "w", encoding="utf-8") as f:
+        json.dump(blocks, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process stored the same version first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    _prune_versions(resource_dir, version)
+    return path
+
+
+def _prune_versions(resource_dir: str, version: str) -> None:
+    """Removes the versions of a resource other than version, and the temporary
+    directories older than config.STORE_TMP_MAX_AGE, the others being those of
+    ingests still running."""
+    oldest = time.time() - config.STORE_TMP_MAX_AGE
+    for entry in os.listdir(resource_dir):
+        entry_path = os.path.join(resource_dir, entry)
+        if entry.endswith(".tmp"):
+            try:
+                if os.path.getmtime(entry_path) >= oldest:
+                    continue
+            except FileNotFoundError:
+                continue
+        elif entry == version:
+            continue
+        shutil.rmtree(entry_path, ignore_errors=True)
+
+
+def _write_block(chunk: pd.DataFrame, path: str, key: str) -> List[str]:
+    """Writes the rows of a block into the dataset at path, and returns the names of
+    its files relative to path."""
+    if chunk.empty:
+        return []
+    if "geoRegion" not in chunk.columns:
+        name = f"part-{key}.parquet"
+        chunk.to_parquet(os.path.join(path, name), index=False)
+        return [name]
+    chunk.to_parquet(
+        path,
+        partition_cols=["geoRegion"],
+        index=False,
+        basename_template=f"part-{key}-{{i}}.parquet",
+    )
+    names = []
+    for region in chunk["geoRegion"].unique():
+        partition = f"geoRegion={region}"
+        for entry in os.listdir(os.path.join(path, partition)):
+            if entry.startswith(f"part-{key}-"):
+                names.append(f"{partition}/{entry}")
+    return names
+
+
+def _link(source: str, target: str) -> None:
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _link_block(source: str, files: List[str], path: str) -> bool:
+    """Links the files of a block of the version at source into the dataset at path,
+    and returns whether they were all still there, the version being removed
+    otherwise. Files of the block already linked are then removed."""
+    linked = []
+    try:
+        for name in files:
+            _link(os.path.join(source, name), os.path.join(path, name))
+            linked.append(name)
+    except FileNotFoundError:
+        for name in linked:
+            os.remove(os.path.join(path, name))
+        return False
+    return True
+
+
+def _previous_blocks(
+    resource_dir: str, schema_key: str
+) -> Dict[str, Tuple[str, List[str]]]:
+    """Returns the blocks of the stored versions of a resource parsed with the schema
+    of schema_key, keyed by block key, with the directory of their version and
+    their file names."""
+    blocks: Dict[str, Tuple[str, List[str]]] = {}
+    if not os.path.isdir(resource_dir):
+        return blocks
+    for entry in os.listdir(resource_dir):
+        blocks_path = os.path.join(resource_dir, entry, _BLOCKS_FILE)
+        if not entry.endswith(f"-{schema_key}") or not os.path.exists(blocks_path):
+            continue
+        try:
+            with open(blocks_path, encoding="utf-8") as f:
+                entry_blocks = json.load(f)
+        except FileNotFoundError:
+            # Removed by another process meanwhile
+            continue
+        for key, files in entry_blocks:
+            blocks[key] = (os.path.join(resource_dir, entry), files)
+    return blocks
+
+
+def _read_stored(resource: Dict[str, Any], region: Optional[str]) -> pd.DataFrame:
+    path = ingest_resource(resource)
+    filters = None
+    if region is not None and any(
+        entry.startswith("geoRegion=") for entry in os.listdir(path)
+    ):
+        filters = [("geoRegion", "==", region)]
+    with stage("load") as record:
+        frame = pd.read_parquet(path, filters=filters)
+        record.rows = len(frame)
+    return frame
+
+
+def load_resource(
+    resource: Dict[str, Any], region: Optional[str] = "CHFL"
+) -> pd.DataFrame:
+    """Returns the rows of resource for region, or for all the regions if None."""
+    key = (resource["download_url"], region)
+    frame = _RESOURCE_FRAMES.get(key)
+    if frame is None:
+        frame = _read_stored(resource, region)
+        _RESOURCE_FRAMES[key] = frame
+    return frame
+
+
+def evict_resource(resource: Dict[str, Any]) -> None:
+    """Drops the frames of resource kept in memory, for all the regions."""
+    for key in [key for key in _RESOURCE_FRAMES if key[0] == resource["download_url"]]:
+        _RESOURCE_FRAMES.pop(key, None)
+
+
+def load_resources(
+    resources: List[Dict[str, Any]], region: Optional[str] = "CHFL"
+) -> List[pd.DataFrame]:
+    """Loads all resources at once, ingesting and reading the missing ones
+    concurrently, and returns their frames in the same order."""
+    missing = {
+        (r["download_url"], region): r
+        for r in resources
+        if (r["download_url"], region) not in _RESOURCE_FRAMES
+    }
+    if missing:
+        with ThreadPoolExecutor(
+            max_workers=min(config.DOWNLOAD_WORKERS, len(missing))
+        ) as pool:
+            frames = pool.map(lambda r: _read_stored(r, region), list(missing.values()))
+            _RESOURCE_FRAMES.update(zip(missing, frames))
+    return [_RESOURCE_FRAMES[(r["download_url"], region)] for r in resources]
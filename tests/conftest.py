@@ -0,0 +1,77 @@
+import functools
+import http.server
+import threading
+import time
+from typing import Any, Dict, Iterator
+
+import pytest
+
+from covid_data import bench, config, series, store
+
+
+class _SlowHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the files of a directory, each response delayed by delay seconds."""
+
+    delay = 0.0
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        time.sleep(self.delay)
+        super().do_GET()
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch) -> str:
+    """Moves every cache under a temporary directory, with empty memory caches."""
+    for name in (
+        "CACHE_DIR",
+        "METADATA_CACHE_DIR",
+        "HTTP_CACHE_DIR",
+        "BUNDLE_CACHE_DIR",
+        "STORE_DIR",
+        "RENDER_CACHE_DIR",
+    ):
+        monkeypatch.setattr(config, name, getattr(config, name))
+    config.set_cache_dir(str(tmp_path / "cache"))
+    monkeypatch.setattr(store, "_RESOURCE_FRAMES", {})
+    monkeypatch.setattr(series, "_CUMULATIVE_INDEXES", {})
+    return config.CACHE_DIR
+
+
+@pytest.fixture(scope="session")
+def data_dir(tmp_path_factory) -> str:
+    path = str(tmp_path_factory.mktemp("data"))
+    bench.generate(path, weeks=20, regions=3, vaccines=2, severities=2)
+    return path
+
+
+def serve_directory(path: str, delay: float = 0.0) -> http.server.HTTPServer:
+    handler = type("Handler", (_SlowHandler,), {"delay": delay})
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(handler, directory=path)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def resources(data_dir) -> Iterator[Dict[str, Dict[str, Any]]]:
+    """The synthetic resources, keyed by identifier, served without delay."""
+    server = serve_directory(data_dir)
+    yield make_resources(server)
+    server.shutdown()
+
+
+def make_resources(server: http.server.HTTPServer) -> Dict[str, Dict[str, Any]]:
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    return {
+        identifier: {
+            "identifier": identifier,
+            "download_url": f"{base}/{name}",
+            "display_name": {"en": identifier},
+            "modified": "2022-04-05T00:00:00",
+        }
+        for identifier, name in bench.RESOURCE_FILES.items()
+    }
@@ -0,0 +1,75 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from covid_data.chart import ChartJob, ChartRenderer, render_job
+from covid_data.counts import AGE_BARS, CovidData
+
+LABELS = CovidData("hosp", "death", "symptoms")
+
+
+def _frame(counts):
+    return pd.DataFrame({"sumTotal": counts}).join(AGE_BARS, how="inner")
+
+
+def _counts(death_unknown=None, hosp_unknown=None, symptoms_unknown=None):
+    known = {f"{age} - {age + 9}": 10 for age in range(0, 80, 10)}
+    known["80+"] = 10
+    death = dict(known)
+    hosp = dict(known)
+    symptoms = {"18 - 44": 5, "45 - 64": 7}
+    for counts, age, value in (
+        (death, "Unbekannt", death_unknown),
+        (hosp, "Unbekannt", hosp_unknown),
+        (symptoms, "unknown", symptoms_unknown),
+    ):
+        if value is not None:
+            counts[age] = value
+    return CovidData(_frame(hosp), _frame(death), _frame(symptoms))
+
+
+@pytest.mark.parametrize(
+    "unknown",
+    [
+        (None, None, None),
+        (0, 3, 0),
+        (None, 3, None),
+        (2, 3, 1),
+        (2, None, None),
+    ],
+)
+def test_render_with_or_without_unknown_ages(unknown):
+    data = ChartRenderer().render(
+        _counts(*unknown), LABELS, date(2021, 1, 1), date(2021, 6, 1), format="svg"
+    )
+    assert data.startswith(b"<?xml")
+
+
+def test_render_job_reuses_cached_charts(tmp_path, monkeypatch):
+    calls = []
+    render = ChartRenderer.render
+
+    def counted_render(self, *args, **kwargs):
+        calls.append(args)
+        return render(self, *args, **kwargs)
+
+    monkeypatch.setattr(ChartRenderer, "render", counted_render)
+    jobs = [
+        ChartJob(
+            _counts(),
+            LABELS,
+            date(2021, 1, 1),
+            date(2021, 6, 1),
+            str(tmp_path / f"chart{i}.png"),
+            "png",
+            "CHFL",
+            str(tmp_path / "cache"),
+        )
+        for i in range(2)
+    ]
+    results = [render_job(job) for job in jobs]
+    assert [result.error for result in results] == [None, None]
+    assert len(calls) == 1
+    charts = [(tmp_path / f"chart{i}.png").read_bytes() for i in range(2)]
+    assert charts[0] == charts[1]
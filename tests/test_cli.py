@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from covid_data import cli, config
+
+
+def test_reversed_window_is_rejected(capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        cli.main(["counts", "-s", "2021-02-01", "-e", "2021-01-01"])
+    assert exit_info.value.code == 2
+    assert "the start 2021-02-01 is after the end 2021-01-01" in capsys.readouterr().err
+
+
+def test_reversed_manifest_window_fails_its_entry(
+    resources, cache_dir, tmp_path, monkeypatch, capsys
+):
+    # main sets them from its options
+    monkeypatch.setattr(config, "OFFLINE", config.OFFLINE)
+    monkeypatch.setattr(config, "BUNDLE", config.BUNDLE)
+    monkeypatch.setattr(
+        cli,
+        "_get_resources",
+        lambda: [resources[identifier] for identifier in cli.RESOURCE_IDS],
+    )
+    output = tmp_path / "counts.csv"
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            [
+                {"command": "counts", "start": "2020-07-01", "end": "2020-06-01"},
+                {
+                    "command": "counts",
+                    "start": "2020-06-01",
+                    "end": "2020-07-01",
+                    "region": "CH",
+                    "output": str(output),
+                },
+            ]
+        )
+    )
+    with pytest.raises(SystemExit) as exit_info:
+        cli.main(["--cache-dir", cache_dir, "batch", str(manifest)])
+    assert exit_info.value.code == 1
+    assert (
+        f"{manifest}[0]: failed, start 2020-07-01 is after end 2020-06-01"
+        in capsys.readouterr().err
+    )
+    assert output.read_text().startswith("region,series,age,")
@@ -0,0 +1,101 @@
+from datetime import date
+
+import pandas as pd
+
+from covid_data.chart import ChartRenderer
+from covid_data.counts import (
+    CovidData,
+    get_counts,
+    get_labels,
+    get_window_counts,
+    index_region_counts,
+    index_window_counts,
+    region_counts,
+)
+from covid_data.series import load_index
+
+START = date(2020, 6, 1)
+END = date(2020, 7, 1)
+
+
+def _indexes(resources):
+    return CovidData(
+        *(
+            load_index(resources[identifier], None)
+            for identifier in (
+                "weekly-hosp-age-range-csv",
+                "weekly-death-age-range-csv",
+                "daily-vacc-symptoms-csv",
+            )
+        )
+    )
+
+
+def test_region_counts_match_get_counts(resources, cache_dir):
+    cube = index_region_counts(_indexes(resources), START, END)
+    death, hosp, symptoms = (
+        resources["weekly-death-age-range-csv"],
+        resources["weekly-hosp-age-range-csv"],
+        resources["daily-vacc-symptoms-csv"],
+    )
+    for region in cube.index.levels[0]:
+        expected = get_counts(death, hosp, symptoms, START, END, region)
+        for name, frame in zip(CovidData._fields, region_counts(cube, region)):
+            assert frame["sumTotal"].sort_index().tolist() == (
+                getattr(expected, name)["sumTotal"].sort_index().tolist()
+            )
+
+
+def test_regions_without_symptoms_keep_their_covid_counts(resources, cache_dir):
+    indexes = _indexes(resources)
+    # Adverse effects only published for the first region
+    symptoms = indexes.symptoms
+    indexes = indexes._replace(
+        symptoms=symptoms._replace(
+            regions=symptoms.regions[:1], values=symptoms.values[:1]
+        )
+    )
+    cube = index_region_counts(indexes, START, END)
+    regions = list(cube.index.levels[0])
+    assert len(regions) == 3
+    labels = get_labels(
+        resources["weekly-death-age-range-csv"],
+        resources["weekly-hosp-age-range-csv"],
+        resources["daily-vacc-symptoms-csv"],
+    )
+    for region in regions[1:]:
+        counts = region_counts(cube, region)
+        assert counts.symptoms.empty
+        assert len(counts.hosp) and len(counts.death)
+        chart = ChartRenderer().render(counts, labels, START, END, format="svg")
+        assert chart.startswith(b"<?xml")
+
+
+def test_repeated_regions_are_counted_once(resources, cache_dir):
+    indexes = _indexes(resources)
+    cube = index_region_counts(indexes, START, END, ["FL", "CH", "FL"])
+    assert list(cube.index.levels[0]) == ["FL", "CH"]
+    assert cube.equals(index_region_counts(indexes, START, END, ["FL", "CH"]))
+    windows = [(START, END)]
+    frame = index_window_counts(indexes, windows, ["CH", "CH"])
+    assert frame.equals(index_window_counts(indexes, windows, ["CH"]))
+
+
+def test_window_counts_match_get_counts(resources, cache_dir):
+    death, hosp, symptoms = (
+        resources["weekly-death-age-range-csv"],
+        resources["weekly-hosp-age-range-csv"],
+        resources["daily-vacc-symptoms-csv"],
+    )
+    windows = [(START, END), (date(2020, 5, 1), START)]
+    frame = get_window_counts(death, hosp, symptoms, windows, "CH")
+    assert set(frame["region"]) == {"CH"}
+    for start_date, end_date in windows:
+        expected = get_counts(death, hosp, symptoms, start_date, end_date, "CH")
+        window = frame[frame["start"] == pd.Timestamp(start_date)]
+        for name in CovidData._fields:
+            counts = window[window["series"] == name].set_index("age")
+            columns = ["sumTotal", "y", "height"]
+            assert counts[columns].sort_index().equals(
+                getattr(expected, name)[columns].sort_index()
+            )
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import time
+
+import pytest
+import requests
+
+from covid_data import config, download, metrics, store
+
+from .conftest import make_resources, serve_directory
+
+DELAY = 0.5
+
+
+def test_load_resources_downloads_concurrently(data_dir, cache_dir):
+    server = serve_directory(data_dir, DELAY)
+    try:
+        resources = list(make_resources(server).values())
+        started = time.perf_counter()
+        for resource in resources:
+            store.load_resource(resource, "CH")
+        sequential = time.perf_counter() - started
+
+        # Same resources from empty caches, so that each one is fetched again
+        config.set_cache_dir(os.path.join(cache_dir, "again"))
+        for resource in resources:
+            store.evict_resource(resource)
+        started = time.perf_counter()
+        frames = store.load_resources(resources, "CH")
+        concurrent = time.perf_counter() - started
+    finally:
+        server.shutdown()
+
+    assert all(len(frame) for frame in frames)
+    assert sequential >= len(resources) * DELAY
+    assert concurrent < sequential - (len(resources) - 1) * DELAY / 2
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    """Status codes of the responses to cached_download, and bytes it received."""
+    statuses = []
+    received = []
+    get = requests.get
+
+    def recorded_get(*args, **kwargs):
+        response = get(*args, **kwargs)
+        statuses.append(response.status_code)
+        return response
+
+    monkeypatch.setattr(download.requests, "get", recorded_get)
+    monkeypatch.setattr(
+        metrics,
+        "HOOKS",
+        [
+            lambda record: received.append(record.bytes)
+            if record.name == "download"
+            else None
+        ],
+    )
+    return statuses, received
+
+
+def test_cached_copy_is_revalidated(data_dir, cache_dir, fetches):
+    statuses, received = fetches
+    server = serve_directory(data_dir)
+    try:
+        url = make_resources(server)["weekly-death-age-range-csv"]["download_url"]
+        path = download.cached_download(url)
+        modified = os.path.getmtime(path)
+        assert download.cached_download(url) == path
+    finally:
+        server.shutdown()
+    assert statuses == [200, 304]
+    assert received[0] == os.path.getsize(os.path.join(data_dir, "death.csv"))
+    assert received[1] == 0
+    assert os.path.getmtime(path) == modified
+
+
+def test_cached_copy_is_used_offline_or_unreachable(
+    data_dir, cache_dir, fetches, monkeypatch
+):
+    statuses, _ = fetches
+    server = serve_directory(data_dir)
+    resources = make_resources(server)
+    url = resources["weekly-death-age-range-csv"]["download_url"]
+    other_url = resources["weekly-hosp-age-range-csv"]["download_url"]
+    try:
+        path = download.cached_download(url)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert download.cached_download(url) == path
+    with pytest.raises(requests.ConnectionError):
+        download.cached_download(other_url)
+    assert len(statuses) == 1
+    monkeypatch.setattr(config, "OFFLINE", True)
+    assert download.cached_download(url) == path
+    with pytest.raises(FileNotFoundError):
+        download.cached_download(other_url)
+    # Nothing left of the failed downloads
+    key = os.path.basename(path)[: -len(".body")]
+    assert sorted(os.listdir(config.HTTP_CACHE_DIR)) == [f"{key}.body", f"{key}.json"]
+
+
+def test_stale_lock_is_broken(data_dir, cache_dir, monkeypatch):
+    monkeypatch.setattr(config, "HTTP_LOCK_TIMEOUT", 0.2)
+    server = serve_directory(data_dir)
+    try:
+        url = make_resources(server)["weekly-death-age-range-csv"]["download_url"]
+        # Lock file of a process killed while holding it
+        os.makedirs(config.HTTP_CACHE_DIR)
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        open(os.path.join(config.HTTP_CACHE_DIR, f"{key}.lock"), "w").close()
+        started = time.perf_counter()
+        path = download.cached_download(url)
+    finally:
+        server.shutdown()
+    assert time.perf_counter() - started < 5
+    assert os.path.getsize(path) == os.path.getsize(os.path.join(data_dir, "death.csv"))
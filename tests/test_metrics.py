@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+from covid_data import metrics
+
+
+def test_data_modules_do_not_import_the_exporters():
+    code = (
+        "import sys\n"
+        "import covid_data.chart, covid_data.counts, covid_data.store\n"
+        "print('prometheus_client' in sys.modules, 'psutil' in sys.modules)\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ).stdout
+    assert output.split() == ["False", "False"]
+
+
+def test_stages_run_before_the_registry_are_exported(tmp_path):
+    with metrics.stage("test_before") as record:
+        record.rows = 5
+    path = tmp_path / "metrics.prom"
+    metrics.write_textfile(str(path))
+    with metrics.stage("test_before") as record:
+        record.bytes = 3
+    with metrics.stage("test_after"):
+        pass
+    metrics.write_textfile(str(path))
+    lines = path.read_text().splitlines()
+    assert 'covid_data_stage_rows_total{stage="test_before"} 5.0' in lines
+    assert 'covid_data_stage_bytes_total{stage="test_before"} 3.0' in lines
+    assert 'covid_data_stage_duration_seconds_count{stage="test_before"} 2.0' in lines
+    assert any(line.startswith("covid_data_stage_rss_bytes{") for line in lines)
+    assert any(line.startswith("covid_data_peak_rss_bytes ") for line in lines)
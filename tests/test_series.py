@@ -0,0 +1,29 @@
+from datetime import date
+
+import numpy as np
+
+from covid_data.series import get_delta, week_keys
+
+
+def test_week_keys():
+    assert week_keys(date(2021, 2, 1)) == 202105
+    assert week_keys(date(2021, 1, 3)) == 202053
+    keys = week_keys([date(2022, 4, 5), date(2022, 4, 11)])
+    assert keys.tolist() == [202214, 202215]
+
+
+def test_week_keys_outside_the_calendar_are_clamped():
+    before, first, last, after = week_keys(
+        np.array(["1999-12-31", "2000-01-01", "2099-12-31", "2100-01-01"])
+    )
+    assert before == first == 199952
+    assert after == last == 209953
+
+
+def test_delta_from_before_the_calendar(resources, cache_dir):
+    death = resources["weekly-death-age-range-csv"]
+    early = get_delta(death, date(1999, 6, 1), date(2021, 6, 1), "CH")
+    assert (early >= 0).all()
+    assert early.equals(get_delta(death, date(2019, 1, 1), date(2021, 6, 1), "CH"))
+    late = get_delta(death, date(2021, 6, 1), date(2150, 1, 1), "CH")
+    assert late.equals(get_delta(death, date(2021, 6, 1), date(2030, 1, 1), "CH"))
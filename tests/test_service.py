@@ -0,0 +1,90 @@
+import asyncio
+import json
+import threading
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.testing
+
+from covid_data import config, service
+from covid_data.cli import RESOURCE_IDS
+
+
+def _fetch(resources, *requests, headers=None):
+    """Serves the synthetic resources, and returns the responses to the requests,
+    (path, body) pairs, GET when the body is None, all sent with headers."""
+    chart_service = service.ChartService()
+    chart_service.snapshot = service.load_snapshot(
+        [resources[identifier] for identifier in RESOURCE_IDS]
+    )
+
+    async def fetch():
+        sock, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(service.make_app(chart_service))
+        server.add_sockets([sock])
+        client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            return [
+                await client.fetch(
+                    f"http://127.0.0.1:{port}{path}",
+                    method="GET" if body is None else "POST",
+                    body=body,
+                    headers=headers,
+                    raise_error=False,
+                )
+                for path, body in requests
+            ]
+        finally:
+            server.stop()
+
+    return asyncio.run(fetch())
+
+
+def test_counts_are_computed_off_the_ioloop(resources, cache_dir, monkeypatch):
+    threads = []
+    index_window_counts = service.index_window_counts
+
+    def recorded(*args):
+        threads.append(threading.current_thread())
+        return index_window_counts(*args)
+
+    monkeypatch.setattr(service, "index_window_counts", recorded)
+    (response,) = _fetch(
+        resources, ("/counts?start=2020-06-01&end=2020-07-01&region=all", None)
+    )
+    assert response.code == 200
+    counts = json.loads(response.body)
+    assert len(counts["data"]) > 0
+    assert threads and threading.main_thread() not in threads
+
+
+def test_counts_queries_above_the_limit_are_rejected(
+    resources, cache_dir, monkeypatch
+):
+    monkeypatch.setattr(config, "SERVICE_MAX_COUNTS", 4)
+    windows = [["2020-06-01", "2020-07-01"], ["2020-07-01", "2020-08-01"]]
+    responses = _fetch(
+        resources,
+        ("/counts", json.dumps({"windows": windows, "regions": ["CH", "FL"]})),
+        ("/counts", json.dumps({"windows": windows, "regions": "all"})),
+        ("/counts?start=2020-06-01&end=2020-07-01&region=all", None),
+    )
+    # Three synthetic regions
+    assert [response.code for response in responses] == [200, 400, 200]
+
+
+def test_invalid_queries_fail_even_with_the_etag(resources, cache_dir):
+    version = service.data_version(
+        [resources[identifier] for identifier in RESOURCE_IDS]
+    )
+    reversed_windows = json.dumps({"windows": [["2020-07-01", "2020-06-01"]]})
+    responses = _fetch(
+        resources,
+        ("/chart?region=CH&format=svg", None),
+        ("/chart?region=XX&format=svg", None),
+        ("/chart?start=2020-07-01&end=2020-06-01&format=svg", None),
+        ("/counts?start=2020-07-01&end=2020-06-01", None),
+        ("/counts", reversed_windows),
+        headers={"If-None-Match": f'"{version}"'},
+    )
+    assert [response.code for response in responses] == [304, 404, 400, 400, 400]
@@ -0,0 +1,204 @@
+import io
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from covid_data import config, metrics, store
+from covid_data.resources import RESOURCE_SPECS, resource_spec
+
+from .conftest import make_resources, serve_directory
+
+HEADER = b"key,value,version\n"
+
+
+def _csv(lines=2000, changed=None, version="v1"):
+    rows = [
+        f"{i},{i * 7 if i != changed else -1},{version}\n".encode()
+        for i in range(lines)
+    ]
+    return HEADER + b"".join(rows)
+
+
+def _blocks(data, key_columns=2):
+    return list(store._split_blocks(io.BytesIO(data), key_columns))
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(config, "STORE_BLOCK_LINES", 32)
+    monkeypatch.setattr(config, "STORE_SCAN_BYTES", 256)
+
+
+def test_blocks_cover_the_file(small_blocks):
+    data = _csv()
+    blocks = _blocks(data)
+    assert len(blocks) > 10
+    assert blocks[0][0] == len(HEADER)
+    assert blocks[-1][1] == len(data)
+    for (_, end, _), (start, _, _) in zip(blocks, blocks[1:]):
+        assert end == start
+    # Only the tail of the file may be a shorter block
+    for start, end, _ in blocks[:-1]:
+        assert data[start:end].count(b"\n") >= config.STORE_BLOCK_LINES // 4
+
+
+def test_digests_do_not_depend_on_the_scan_size(small_blocks, monkeypatch):
+    data = _csv()
+    blocks = _blocks(data)
+    monkeypatch.setattr(config, "STORE_SCAN_BYTES", 1 << 20)
+    assert _blocks(data) == blocks
+
+
+def test_digests_skip_the_columns_not_parsed(small_blocks):
+    digests = [digest for _, _, digest in _blocks(_csv(version="v1"))]
+    assert [digest for _, _, digest in _blocks(_csv(version="v22"))] == digests
+    assert [digest for _, _, digest in _blocks(_csv(version="v22"), 3)] != digests
+
+
+def test_changed_line_only_changes_its_blocks(small_blocks):
+    digests = [digest for _, _, digest in _blocks(_csv())]
+    changed = [digest for _, _, digest in _blocks(_csv(changed=1000))]
+    assert len(set(changed) - set(digests)) <= 2
+    assert len(set(digests) - set(changed)) <= 2
+
+
+def test_lines_without_cuts_make_bounded_blocks(small_blocks, monkeypatch):
+    # No line hashes to a multiple of STORE_BLOCK_LINES
+    monkeypatch.setattr(
+        store, "_cut_hashes", lambda data, starts, key_ends: np.ones_like(starts)
+    )
+    data = _csv()
+    blocks = _blocks(data)
+    assert blocks[-1][1] == len(data)
+    for start, end, _ in blocks:
+        assert 0 < data[start:end].count(b"\n") <= 4 * config.STORE_BLOCK_LINES
+    monkeypatch.setattr(config, "STORE_SCAN_BYTES", 1 << 20)
+    assert _blocks(data) == blocks
+
+
+def _republish(path):
+    """Changes the sumTotal of the first row of the CSV file at path."""
+    with open(path, encoding="utf-8") as f:
+        lines = f.readlines()
+    columns = lines[0].strip().split(",")
+    values = lines[1].strip().split(",")
+    values[columns.index("sumTotal")] = "123456"
+    lines[1] = ",".join(values) + "\n"
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    # Later than the Last-Modified of the cached download, whole seconds apart
+    modified = os.path.getmtime(path) + 60
+    os.utime(path, (modified, modified))
+
+
+def _sorted(frame):
+    """Returns the rows of frame in a fixed order, with its categories as strings."""
+    frame = frame.astype(
+        {c: str for c in frame.columns if frame[c].dtype == "category"}
+    )
+    columns = sorted(frame.columns)
+    return frame[columns].sort_values(columns).reset_index(drop=True)
+
+
+@pytest.fixture
+def republished(data_dir, tmp_path, cache_dir, monkeypatch):
+    """Ingests the hosp resource, republishes it with one row changed, and returns
+    the republished resource and the rows parsed by each ingest."""
+    monkeypatch.setattr(config, "STORE_BLOCK_LINES", 32)
+    served = str(tmp_path / "served")
+    shutil.copytree(data_dir, served)
+    server = serve_directory(served)
+    rows = []
+    monkeypatch.setattr(
+        metrics,
+        "HOOKS",
+        [lambda record: rows.append(record.rows) if record.name == "parse" else None],
+    )
+    try:
+        resource = make_resources(server)["weekly-hosp-age-range-csv"]
+        store.ingest_resource(resource)
+        first = os.path.join(config.STORE_DIR, resource["identifier"])
+        previous = [os.path.join(first, entry) for entry in os.listdir(first)]
+        _republish(os.path.join(served, "hosp.csv"))
+        resource = dict(resource, modified="2022-04-12T00:00:00")
+        yield resource, previous[0], rows
+    finally:
+        server.shutdown()
+
+
+def test_republished_resource_only_parses_changed_blocks(republished):
+    resource, _, rows = republished
+    path = store.ingest_resource(resource)
+    expected = _sorted(store.parse_resource(resource))
+    pd.testing.assert_frame_equal(_sorted(pd.read_parquet(path)), expected)
+    assert 123456 in expected["sumTotal"].tolist()
+    assert 0 < rows[1] < len(expected) / 4
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+
+
+def test_blocks_removed_meanwhile_are_parsed_again(republished):
+    resource, previous, rows = republished
+    # Another process pruning the previous version while it is linked from
+    for directory, _, files in os.walk(previous):
+        for name in files:
+            if name.endswith(".parquet"):
+                os.remove(os.path.join(directory, name))
+    path = store.ingest_resource(resource)
+    expected = _sorted(store.parse_resource(resource))
+    pd.testing.assert_frame_equal(_sorted(pd.read_parquet(path)), expected)
+    assert rows[1] == len(expected)
+
+
+def test_only_stale_temporary_directories_are_removed(republished):
+    resource, previous, _ = republished
+    resource_dir = os.path.dirname(previous)
+    stale = os.path.join(resource_dir, f"{os.path.basename(previous)}.1.2.tmp")
+    running = os.path.join(resource_dir, f"{os.path.basename(previous)}.3.4.tmp")
+    os.makedirs(stale)
+    os.makedirs(running)
+    old = time.time() - config.STORE_TMP_MAX_AGE - 60
+    os.utime(stale, (old, old))
+    path = store.ingest_resource(resource)
+    assert sorted(os.listdir(resource_dir)) == sorted(
+        [os.path.basename(path), os.path.basename(running)]
+    )
+
+
+def test_blocks_are_parsed_in_chunks(resources, cache_dir, monkeypatch):
+    monkeypatch.setattr(config, "STORE_BLOCK_LINES", 32)
+    monkeypatch.setattr(config, "CSV_CHUNK_ROWS", 7)
+    resource = resources["weekly-death-age-range-csv"]
+    path = store.ingest_resource(resource)
+    with open(os.path.join(path, store._BLOCKS_FILE), encoding="utf-8") as f:
+        blocks = json.load(f)
+    # Files of the second chunk of a block
+    assert any(f"part-{key}-1-" in name for key, files in blocks for name in files)
+    pd.testing.assert_frame_equal(
+        _sorted(pd.read_parquet(path)), _sorted(store.parse_resource(resource))
+    )
+
+
+def test_columns_missing_from_the_file_are_reported(
+    resources, cache_dir, monkeypatch
+):
+    resource = resources["weekly-death-age-range-csv"]
+    spec = resource_spec(resource)
+    monkeypatch.setitem(
+        RESOURCE_SPECS,
+        resource["identifier"],
+        spec._replace(
+            schema=dict(spec.schema, inz_missing="Int32"),
+            measures=spec.measures + ("inz_missing",),
+        ),
+    )
+    message = "weekly-death-age-range-csv has no column inz_missing"
+    with pytest.raises(ValueError, match=message):
+        store.ingest_resource(resource)
+    with pytest.raises(ValueError, match=message):
+        store.parse_resource(resource)
+    assert not os.path.exists(config.STORE_DIR)